@@ -0,0 +1,987 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import heapq
+import itertools
+import io
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import socket
+import sqlite3
+import string
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+from Block import Block
+from Blockchain import Blockchain
+from ChainStore import ChainStore
+from ChainValidator import first_invalid_block
+from BlockchainFetcher import BlockchainFetcher
+from Sardukar import Peer
+from PeerScoreboard import PeerScoreboard
+from SeenCache import SeenCache
+from MiningPool import block_template, mine_nonce_range
+
+
+# A difficulty no nonce can meet, so every kernel hashes the full range
+UNREACHABLE_DIFFICULTY = 64
+
+
+def quietly():
+    """Swallow the per-block prints of the code under test."""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def synthetic_chain(length, difficulty=1, base=None, miner="Benchmark"):
+    """
+    Mine a chain of `length` blocks (genesis included) at a low difficulty.
+
+    Args:
+        base: Chain to extend instead of starting from the genesis block.
+        miner: minedBy name, so two extensions of one base fork apart.
+    """
+    chain = list(base) if base else Blockchain().chain
+    with quietly():
+        for height in range(len(chain), length):
+            block = Block(height, miner, [f"block {height}"], '', chain[-1].timestamp + 1)
+            block.nonce, block.hash = mine_nonce_range(
+                chain[-1].hash, block_template(block), 0, 16 ** (difficulty + 4), difficulty
+            )
+            chain.append(block)
+    return chain
+
+
+def replaced(block, **changes):
+    """A copy of `block` with some fields changed."""
+    return Block(**{**{field: getattr(block, field) for field in Block.__slots__}, **changes})
+
+
+class StandInPeer(Peer):
+    """
+    A Peer on localhost serving a fixed chain, dropping a fraction of
+    requests and delaying the rest. A legacy one ignores GET_BLOCKS, like
+    peers that predate it.
+    """
+
+    def __init__(self, chain, drop_rate=0.0, delay=0.0, legacy=False):
+        super().__init__('127.0.0.1', 0)
+        self.blockchain.replace_chain(chain)
+        self.drop_rate = drop_rate
+        self.delay = delay
+        self.legacy = legacy
+        self.requests = 0  # Messages received, dropped ones included
+        self.address = self.sock.getsockname()
+        self.loop = asyncio.new_event_loop()
+        self.server = threading.Thread(target=self.loop.run_until_complete, args=(self.serve(),), daemon=True)
+        self.server.start()
+
+    def handle_message(self, message, addr):
+        self.requests += 1
+        if random.random() < self.drop_rate or (self.legacy and message.get("type") == "GET_BLOCKS"):
+            return
+        if self.delay:
+            time.sleep(self.delay)
+        super().handle_message(message, addr)
+
+    def stop(self):
+        self.running = False
+        self.loop.call_soon_threadsafe(self.stopped.set)
+        self.server.join()
+        self.loop.close()
+
+
+class SimulatedNetwork:
+    """
+    Carries datagrams between in-process Peers in simulated time.
+
+    Each attached peer's sends are captured and delivered to the addressed
+    peer's handle_datagram after a random latency, so hundreds of peers run
+    their real message handlers in one process and minutes of gossip
+    rounds take a moment.
+    """
+
+    def __init__(self, latency=(0.001, 0.020), drop_rate=0.0):
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.now = 0.0
+        self.events = []  # Heap of (time, tie-breaker, callback)
+        self.order = itertools.count()
+        self.peers = {}  # (host, port) -> Peer
+        self.watched_id = None
+        self.watched_sends = 0  # Datagrams carrying watched_id
+
+    def attach(self, peer, address):
+        peer.host, peer.port = address
+        self.peers[address] = peer
+        peer.send_bytes = lambda data, destination, source=address: self.send(source, data, destination)
+
+    def schedule(self, delay, callback):
+        heapq.heappush(self.events, (self.now + delay, next(self.order), callback))
+
+    def send(self, source, data, destination):
+        if self.watched_id is not None and json.loads(data).get("id") == self.watched_id:
+            self.watched_sends += 1
+        if destination in self.peers and random.random() >= self.drop_rate:
+            peer = self.peers[destination]
+            self.schedule(random.uniform(*self.latency), lambda: peer.handle_datagram(data, source))
+
+    def run_until(self, end):
+        while self.events and self.events[0][0] <= end:
+            self.now, _, callback = heapq.heappop(self.events)
+            callback()
+        self.now = end
+
+
+def legacy_poll_peer_stats(peer, peers, timeout):
+    """The old STATS poll: one peer at a time, each on a fresh socket with its own timeout."""
+    replies = []
+    for peer_host, peer_port in peers:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.sendto(json.dumps({"type": "STATS"}).encode(), (peer_host, peer_port))
+            try:
+                stats = json.loads(sock.recv(4096))
+            except socket.timeout:
+                continue
+            replies.append(((peer_host, peer_port), stats["height"] - 1))
+    return replies
+
+
+def legacy_mine_nonce_range(block_data, start_nonce, end_nonce, difficulty, result_queue):
+    """The original per-nonce JSON mining loop, kept as the baseline."""
+    target = '0' * difficulty
+    for nonce in range(start_nonce, end_nonce):
+        if not result_queue.empty():
+            return
+        block_data['nonce'] = str(nonce)
+        block_hash = hashlib.sha256(json.dumps(block_data, sort_keys=True).encode()).hexdigest()
+        if block_hash.endswith(target):
+            result_queue.put((nonce, block_hash))
+            return
+
+
+def sample_block():
+    """Build a block template on top of the genesis block."""
+    blockchain = Blockchain()
+    block = Block(1, "Nico Rosberg", ["Jihan", "Park", "Mirha"], '', int(time.time()))
+    return blockchain, block
+
+
+def time_kernel(kernel, args, nonces):
+    """Run a mining kernel over `nonces` nonces and return hashes/sec."""
+    start = time.perf_counter()
+    kernel(*args)
+    return nonces / (time.perf_counter() - start)
+
+
+def bench_hashrate(args):
+    """Compare single-core hash rate of the JSON kernel and the midstate kernel."""
+    blockchain, block = sample_block()
+    prev_hash = blockchain.chain[0].hash
+    # Start high enough that nonces have realistic lengths
+    start = 10 ** 9
+    end = start + args.nonces
+
+    before = time_kernel(
+        legacy_mine_nonce_range,
+        (block.to_wire(), start, end, UNREACHABLE_DIFFICULTY, queue.Queue()),
+        args.nonces,
+    )
+    after = time_kernel(
+        mine_nonce_range,
+        (prev_hash, block_template(block), start, end, UNREACHABLE_DIFFICULTY),
+        args.nonces,
+    )
+    print(f"Hashes/sec per core over {args.nonces} nonces:")
+    print(f"- Before (JSON per nonce): {before:,.0f}")
+    print(f"- After (midstate):        {after:,.0f}")
+    print(f"- Speedup:                 {after / before:.2f}x")
+
+
+def random_block(height):
+    """Build a random block template on top of `height - 1`."""
+    words = [
+        ''.join(random.choices(string.ascii_letters, k=random.randint(0, Blockchain.MAX_MESSAGE_LENGTH)))
+        for _ in range(random.randint(0, Blockchain.MAX_MESSAGES))
+    ]
+    return Block(
+        height=height,
+        mined_by=''.join(random.choices(string.printable, k=random.randint(1, 20))),
+        messages=words,
+        nonce='',
+        timestamp=random.randint(0, 2 ** 40),
+    )
+
+
+def bench_verify_mining(args):
+    """
+    Mine random blocks at a low difficulty and check that the chain's own
+    validation accepts every one of them. Exits non-zero on the first
+    block that is rejected.
+    """
+    blockchain = Blockchain()
+    blockchain.DIFFICULTY = args.difficulty
+    mined = 0
+    start = time.perf_counter()
+    for height in range(1, args.blocks + 1):
+        block = random_block(height)
+        start_nonce = random.randint(0, 10 ** 12)
+        found = mine_nonce_range(
+            blockchain.tip.hash, block_template(block), start_nonce, start_nonce + 16 ** (args.difficulty + 2),
+            args.difficulty
+        )
+        if not found:
+            continue
+        block.nonce, block.hash = found
+        if not blockchain.is_valid_block(block, blockchain.tip):
+            raise SystemExit(f"Mined block at height {height} was rejected: {block}")
+        blockchain.append_block(block)
+        mined += 1
+    elapsed = time.perf_counter() - start
+    print(f"{mined} random blocks mined at difficulty {args.difficulty}, all accepted by is_valid_block.")
+    print(f"- Valid blocks/hour at this difficulty: {mined / elapsed * 3600:,.0f}")
+
+
+class RecordingHash:
+    """
+    A sha256 object that notes every (template, nonce) it is asked to digest.
+
+    The template is told apart by the digest of the state it started from;
+    the nonce is every byte fed in after that.
+    """
+
+    def __init__(self, state, hashed, template=None, suffix=b''):
+        self.state = state
+        self.hashed = hashed
+        self.template = template if template is not None else state.digest()
+        self.suffix = suffix
+
+    def update(self, data):
+        self.state.update(data)
+        self.suffix += bytes(data)
+
+    def copy(self):
+        return RecordingHash(self.state.copy(), self.hashed, self.template, self.suffix)
+
+    def digest(self):
+        self.hashed.append((self.template, self.suffix))
+        return self.state.digest()
+
+
+def bench_partition(args):
+    """
+    Check that peers mining under one name never hash the same (template, nonce).
+
+    Runs the real mining_worker loop for `--nodes` node indexes with
+    `--workers` workers each, `--restarts` times apiece, on one shared
+    template. Each run hashes `--chunks` chunks, gets the same template
+    re-sent as a new generation, hashes `--chunks` more and exits. Every
+    digest the kernel takes is recorded, so a worker that stopped folding
+    its prefix into the midstate, or reset its extra nonce on a new
+    generation, shows up as a repeat. Exits non-zero on the first one.
+    """
+    import MiningPool
+
+    chunk_size = 100
+    template = (Blockchain().tip.hash, block_template(Block(1, "Benchmark", ["partition"], '', int(time.time()))))
+    owners = {}  # (template, nonce) -> (node, worker, restart)
+    real_hash_prefix = MiningPool.hash_prefix
+    try:
+        for node in range(args.nodes):
+            for worker in range(args.workers):
+                for restart in range(args.restarts):
+                    hashed = []
+                    conn, worker_conn = multiprocessing.Pipe()
+                    generation = multiprocessing.RawValue('q', 1)
+                    chunks = 0
+
+                    def recording_hash_prefix(*prefix_args):
+                        # One call per chunk: re-send the template halfway, stop at the end
+                        nonlocal chunks
+                        chunks += 1
+                        if chunks in (args.chunks + 1, 2 * args.chunks + 1):
+                            generation.value += 1
+                            conn.send((generation.value, template) if chunks == args.chunks + 1 else (None, None))
+                        return RecordingHash(real_hash_prefix(*prefix_args), hashed)
+
+                    MiningPool.hash_prefix = recording_hash_prefix
+                    conn.send((1, template))
+                    with quietly():
+                        MiningPool.mining_worker(
+                            worker, worker_conn, generation, [0] * args.workers, queue.Queue(),
+                            UNREACHABLE_DIFFICULTY, chunk_size, node
+                        )
+                    conn.close()
+                    worker_conn.close()
+                    for key in hashed:
+                        if key in owners:
+                            raise SystemExit(f"Nonce {key[1]!r} hashed by both {owners[key]} and {(node, worker, restart)}")
+                        owners[key] = (node, worker, restart)
+    finally:
+        MiningPool.hash_prefix = real_hash_prefix
+    print(f"{len(owners):,} nonces hashed by mining_worker across {args.nodes} nodes x {args.workers} workers "
+          f"x {args.restarts} restarts: no (template, nonce) hashed twice.")
+
+
+def bench_fetch(args):
+    """
+    Sync a synthetic chain from local stand-in peers and report blocks/sec:
+    with a single request in flight (the old behaviour), with the window,
+    and with the window again reusing the scores the first windowed run
+    learned. Slow, dead and lying peers can be mixed in to check that
+    scoring and mid-sync validation route around them. Exits non-zero if a
+    fetched chain differs from the served one.
+    """
+    chain = synthetic_chain(args.blocks)
+    # Lying peers serve every block after genesis with a tampered message
+    forged = chain[:1] + [replaced(block, messages=["forged"]) for block in chain[1:]]
+    peers = [StandInPeer(chain, args.drop_rate) for _ in range(args.peers)]
+    peers += [StandInPeer(chain, args.drop_rate, args.slow_delay) for _ in range(args.slow_peers)]
+    peers += [StandInPeer(forged, args.drop_rate) for _ in range(args.bad_peers)]
+    peers += [StandInPeer(chain, args.drop_rate, legacy=True) for _ in range(args.legacy_peers)]
+    # Dead peers are bound sockets nobody reads, so requests to them just vanish
+    dead = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(args.dead_peers)]
+    for sock in dead:
+        sock.bind(('127.0.0.1', 0))
+    addresses = [peer.address for peer in peers] + [sock.getsockname() for sock in dead]
+    scoreboard = PeerScoreboard()
+    try:
+        for label, window_size, board, batch_size in (
+                ("Window 1", 1, PeerScoreboard(), 1),
+                (f"Window {args.window}", args.window, scoreboard, 1),
+                (f"Window {args.window}, scored", args.window, scoreboard, 1),
+                (f"Window {args.window}, GET_BLOCKS", args.window, scoreboard, args.batch)):
+            target = Blockchain()
+            target.DIFFICULTY = 1
+            fetcher = BlockchainFetcher(target, window_size=window_size, fetch_peers=None, scoreboard=board,
+                                        batch_size=batch_size)
+            with quietly():
+                fetcher.fetch_all_blocks(addresses, addresses[0], len(chain) - 1, start_height=1)
+            if target.chain != chain:
+                raise SystemExit(f"{label}: fetched {len(target.chain)} blocks that do not match the source chain")
+            served = [list(fetcher.sources.values()).count(address) for address in addresses]
+            print(f"- {label:<22}: {fetcher.blocks_per_second:,.0f} blocks/sec, {fetcher.requests:,} requests, "
+                  f"blocks per peer {served}")
+    finally:
+        for peer in peers:
+            peer.stop()
+        for sock in dead:
+            sock.close()
+
+
+def bench_sync(args):
+    """
+    Run consensus on a peer that is behind a stand-in peer, and on one whose
+    tip forked off, counting the requests each sync sends. Exits non-zero if
+    a synced chain differs from the served one.
+    """
+    served = synthetic_chain(args.blocks)
+    behind = args.blocks - args.new_blocks
+    forked = synthetic_chain(behind, base=served[:behind - args.fork_depth], miner="Fork")
+    scenarios = (("behind", served[:behind], args.new_blocks),
+                 ("forked", forked, args.new_blocks + args.fork_depth))
+    source = StandInPeer(served)
+    try:
+        for label, local_chain, missing in scenarios:
+            peer = Peer('127.0.0.1', 0)
+            peer.blockchain.DIFFICULTY = 1
+            peer.blockchain.replace_chain(list(local_chain))
+            peer.well_known_peers = [source.address]
+            peer.fetch_peers = None
+            source.requests = 0
+            start = time.time()
+            with quietly():
+                peer.perform_consensus()
+            elapsed = time.time() - start
+            peer.sock.close()
+            if peer.blockchain.chain != served:
+                raise SystemExit(f"{label}: synced chain does not match the served one")
+            print(f"- {label}: {missing} missing blocks synced with {source.requests} requests "
+                  f"in {elapsed:.2f}s (full refetch: {len(served) + 1})")
+    finally:
+        source.stop()
+
+
+def bench_validate(args):
+    """
+    Verify a synthetic chain with the old per-block loop, in-process, and
+    across worker processes, then corrupt one block and check every way
+    reports the same first failing height.
+    """
+    chain = synthetic_chain(args.blocks)
+    blockchain = Blockchain()
+    blockchain.DIFFICULTY = 1
+    processes = args.processes or multiprocessing.cpu_count()
+
+    def old_loop(chain):
+        with quietly():
+            for height in range(1, len(chain)):
+                if not blockchain.is_valid_block(chain[height], chain[height - 1]):
+                    return height
+        return None
+
+    bad_height = random.randrange(len(chain) // 2, len(chain))
+    corrupt = list(chain)
+    corrupt[bad_height] = replaced(corrupt[bad_height], nonce=corrupt[bad_height].nonce + "0")
+    print(f"{len(chain):,} blocks, corrupt copy invalid from height {bad_height}:")
+    for label, check in (("per-block loop", old_loop),
+                         ("in-process", lambda chain: first_invalid_block(chain, 1, 1, processes=1)),
+                         (f"{processes} processes", lambda chain: first_invalid_block(chain, 1, 1, processes=processes))):
+        start = time.time()
+        valid = check(chain)
+        elapsed = time.time() - start
+        found = check(corrupt)
+        if valid is not None or found != bad_height:
+            raise SystemExit(f"{label}: reported {valid} / {found}, expected None / {bad_height}")
+        print(f"- {label:<16}: {elapsed:.2f}s ({len(chain) / elapsed:,.0f} blocks/sec)")
+
+
+def bench_store(args):
+    """
+    Save a synthetic chain block by block through a ChainStore, then time a
+    cold start (open, load, verify since the checkpoint). Finally corrupt the
+    newest stored block and check a restart drops it.
+    """
+    chain = synthetic_chain(args.blocks)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "chain.db")
+        blockchain = Blockchain()
+        blockchain.DIFFICULTY = 1
+        store = ChainStore(path)
+        with quietly():
+            blockchain.attach_store(store)
+        start = time.time()
+        for block in chain[1:]:
+            blockchain.append_block(block)
+        store.close()
+        elapsed = time.time() - start
+        print(f"- Appended {len(chain) - 1:,} blocks in {elapsed:.2f}s ({(len(chain) - 1) / elapsed:,.0f} blocks/sec)")
+
+        start = time.time()
+        restarted = Blockchain()
+        restarted.DIFFICULTY = 1
+        store = ChainStore(path)
+        with quietly():
+            restarted.attach_store(store)
+        elapsed = time.time() - start
+        if restarted.chain != chain:
+            raise SystemExit("Restarted chain does not match the saved one")
+        print(f"- Cold start with {len(chain):,} blocks: {elapsed * 1000:.0f} ms "
+              f"(checkpoint at {store.checkpoint}, {len(chain) - 1 - store.checkpoint} blocks verified)")
+        store.close()
+
+        # A torn or tampered write at the tip must not survive a restart
+        conn = sqlite3.connect(path)
+        conn.execute("UPDATE blocks SET block = ? WHERE height = ?",
+                     (json.dumps(replaced(chain[-1], nonce="tampered").to_wire()), len(chain) - 1))
+        conn.commit()
+        conn.close()
+        restarted = Blockchain()
+        restarted.DIFFICULTY = 1
+        store = ChainStore(path)
+        with quietly():
+            restarted.attach_store(store)
+        store.close()
+        if restarted.chain != chain[:-1]:
+            raise SystemExit("Tampered tip block was not dropped on restart")
+        print("- Tampered tip block dropped on restart")
+
+
+def bench_memory(args):
+    """
+    Bytes per block held by a chain of plain dicts as parsed off the wire
+    (the old representation) and by the same chain as Block records.
+    """
+    wire = json.dumps([block.to_wire() for block in synthetic_chain(args.blocks)])
+
+    def measure(parse):
+        tracemalloc.start()
+        chain = parse(wire)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return chain, size / len(chain)
+
+    dicts, dict_size = measure(json.loads)
+    del dicts
+    # Parse first so only the Blocks themselves are still traced at the end
+    blocks, block_size = measure(lambda text: [Block.from_wire(block) for block in json.loads(text)])
+    print(f"Memory per block over {len(blocks):,} blocks:")
+    print(f"- dict:  {dict_size:,.0f} bytes")
+    print(f"- Block: {block_size:,.0f} bytes ({block_size / dict_size:.0%})")
+
+
+def bench_tip(args):
+    """
+    Validating a block on the tip against recomputing the previous block's
+    state each time, then Blockchain.get_stats and the peer's STATS reply:
+    built from the chain list and encoded per request as the old handler
+    did, encoded per request by Peer.encoded_stats_reply, and reused from
+    its per-tip cache.
+    """
+    chain = synthetic_chain(args.blocks + 1)
+    peer = Peer('127.0.0.1', 0)
+    blockchain = peer.blockchain
+    blockchain.DIFFICULTY = 1
+    blockchain.replace_chain(chain[:-1])
+    candidate = chain[-1]
+    uncached_tip = replaced(blockchain.tip)  # An equal block that is not the cached tip
+    if blockchain.tip_height != len(chain) - 2 or blockchain.tip_hash_hex != chain[-2].hash_hex:
+        raise SystemExit(f"Cached tip {blockchain.tip_height}/{blockchain.tip_hash_hex} does not match the chain")
+    expected = {"type": "STATS_REPLY", "height": len(chain) - 1, "hash": chain[-2].hash_hex}
+    if json.loads(peer.encoded_stats_reply()) != expected:
+        raise SystemExit(f"STATS reply {peer.encoded_stats_reply()!r} does not match the chain")
+
+    def rate(action):
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            action()
+        return args.iterations / (time.perf_counter() - start)
+
+    def stats_before():
+        return json.dumps({"type": "STATS_REPLY", "height": len(blockchain.chain),
+                           "hash": blockchain.chain[-1].hash_hex if blockchain.chain else None}).encode()
+
+    def stats_encoded():
+        peer.stats_reply = (None, None)  # Drop the cache, so every call encodes
+        return peer.encoded_stats_reply()
+
+    try:
+        with quietly():
+            if not (blockchain.is_valid_block(candidate, blockchain.tip)
+                    and blockchain.is_valid_block(candidate, uncached_tip)):
+                raise SystemExit("Candidate block was rejected")
+            validations = [(label, rate(lambda: blockchain.is_valid_block(candidate, prev, verbose=False)))
+                           for label, prev in (("recomputed", uncached_tip), ("cached", blockchain.tip))]
+        print(f"Operations/sec on a {len(chain) - 1:,}-block chain:")
+        for label, per_second in validations:
+            print(f"- validate on tip, {label:<10}: {per_second:,.0f}")
+        print(f"- get_stats                  : {rate(blockchain.get_stats):,.0f}")
+        for label, build in (("before", stats_before), ("encoded", stats_encoded),
+                             ("cached", peer.encoded_stats_reply)):
+            print(f"- STATS reply, {label:<10}    : {rate(build):,.0f}")
+    finally:
+        peer.sock.close()
+
+
+def bench_forks(args):
+    """
+    Two peers mine competing branches off a shared chain, then hear each
+    other's blocks only through shuffled ANNOUNCE messages. Exits non-zero
+    unless both settle on the longer branch, and the first peer switches
+    back when its own branch overtakes again.
+    """
+    base = synthetic_chain(args.blocks)
+    branch_a = synthetic_chain(args.blocks + args.fork_depth + 2, base=base, miner="Branch A")
+    branch_b = synthetic_chain(args.blocks + args.fork_depth + 1, base=base, miner="Branch B")
+    peers = []
+    for own in (branch_a[:-2], branch_b):
+        peer = Peer('127.0.0.1', 0)
+        peer.blockchain.DIFFICULTY = 1
+        peer.blockchain.replace_chain(list(own))
+        peers.append(peer)
+    peer_a, peer_b = peers
+
+    def announce(peer, blocks):
+        messages = [block.to_wire("ANNOUNCE") for block in blocks]
+        random.shuffle(messages)  # Out of order, so children arrive before their parents
+        start = time.perf_counter()
+        with quietly():
+            for message in messages:
+                peer.handle_announce(message)
+        return (time.perf_counter() - start) / len(messages)
+
+    try:
+        rounds = (("B's branch to A", peer_a, branch_b[args.blocks:], branch_b),
+                  ("A's branch to B", peer_b, branch_a[args.blocks:-2], branch_b),
+                  ("A's next 2 to A", peer_a, branch_a[-2:], branch_a))
+        print(f"Forks {args.fork_depth} blocks deep off a {args.blocks:,}-block chain:")
+        for label, peer, blocks, expected in rounds:
+            before = peer.block_tree.summary()
+            per_block = announce(peer, blocks)
+            if peer.blockchain.chain != expected:
+                raise SystemExit(f"{label}: peer did not settle on the expected branch")
+            tree = peer.block_tree.summary()
+            print(f"- {label}: {len(blocks)} announcements, {per_block * 1e6:,.0f} us each, "
+                  f"{tree['reorgs'] - before['reorgs']} reorgs rolling back "
+                  f"{tree['rolled_back'] - before['rolled_back']} blocks, {tree['side_blocks']} side blocks kept")
+    finally:
+        for peer in peers:
+            peer.sock.close()
+
+
+def bench_latency(args):
+    """
+    GET_BLOCK round trips to a peer that is idle and while it runs a
+    consensus triggered by a CONSENSUS message, with consensus in a worker
+    thread as the peer now runs it and inline in the handler as the old
+    listener thread did. Exits non-zero if a consensus does not sync.
+    """
+    served = synthetic_chain(args.blocks)
+    behind = served[:len(served) // 2]
+    source = StandInPeer(served, delay=args.source_delay)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(10)
+
+    def round_trips(peer, until):
+        """GET_BLOCK latencies in seconds, one request at a time, until `until()` holds."""
+        latencies = []
+        while not until():
+            request = json.dumps({"type": "GET_BLOCK", "height": random.randrange(len(behind))}).encode()
+            sent = time.perf_counter()
+            client.sendto(request, peer.address)
+            client.recv(4096)
+            latencies.append(time.perf_counter() - sent)
+        return latencies
+
+    def describe(latencies):
+        latencies = sorted(latencies)
+        p50, p99 = (latencies[int(q * (len(latencies) - 1))] * 1000 for q in (0.5, 0.99))
+        return f"{len(latencies):>6,} requests, p50 {p50:7.2f} ms, p99 {p99:8.2f} ms, max {latencies[-1] * 1000:8.2f} ms"
+
+    try:
+        for label, inline in (("consensus task", False), ("inline consensus", True)):
+            peer = StandInPeer(behind)
+            peer.blockchain.DIFFICULTY = 1
+            peer.well_known_peers = [source.address]
+            peer.fetch_peers = None
+            if inline:
+                # The old listener ran consensus in the handler itself
+                peer.start_consensus = peer.perform_consensus
+            try:
+                with quietly():
+                    idle_until = time.perf_counter() + args.idle
+                    idle = round_trips(peer, lambda: time.perf_counter() > idle_until)
+                    client.sendto(json.dumps({"type": "CONSENSUS"}).encode(), peer.address)
+                    started = time.perf_counter()
+                    syncing = round_trips(peer, lambda: peer.blockchain.tip_height == len(served) - 1)
+                    elapsed = time.perf_counter() - started
+            finally:
+                peer.stop()
+            if peer.blockchain.chain != served:
+                raise SystemExit(f"{label}: consensus did not sync the served chain")
+            print(f"{label} ({len(served) - len(behind):,} blocks synced in {elapsed:.2f}s):")
+            print(f"- idle            : {describe(idle)}")
+            print(f"- during consensus: {describe(syncing)}")
+    finally:
+        client.close()
+        source.stop()
+
+
+def bench_replies(args):
+    """
+    GET_BLOCK and STATS replies/sec from a stand-in peer on a local socket,
+    with the encoded reply caches and with every reply encoded afresh.
+    Exits non-zero if a cached reply differs from a freshly encoded one.
+    """
+    chain = synthetic_chain(args.blocks)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(1)
+
+    def rate(peer, make_request):
+        """Replies/sec with `args.window` requests kept outstanding."""
+        replies = 0
+        for _ in range(args.window):
+            client.sendto(make_request(), peer.address)
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.seconds:
+            try:
+                client.recv(4096)
+            except socket.timeout:
+                client.sendto(make_request(), peer.address)  # A request or reply was dropped
+                continue
+            replies += 1
+            client.sendto(make_request(), peer.address)
+        elapsed = time.perf_counter() - start
+        # Drain the replies still on their way
+        with contextlib.suppress(socket.timeout):
+            while True:
+                client.recv(4096)
+        return replies / elapsed
+
+    get_block = lambda: json.dumps({"type": "GET_BLOCK", "height": random.randrange(len(chain))}).encode()
+    stats = lambda: b'{"type": "STATS"}'
+    try:
+        for label, cached in (("encoded per reply", False), ("cached", True)):
+            peer = StandInPeer(chain)
+            if cached:
+                for height in range(len(chain)):
+                    if peer.encoded_block_reply(height) != json.dumps(chain[height].to_wire()).encode():
+                        raise SystemExit(f"Cached reply for block {height} differs from a fresh encoding")
+            else:
+                peer.REPLY_CACHE_SIZE = 0
+                peer.encoded_stats_reply = lambda peer=peer: json.dumps({
+                    "type": "STATS_REPLY",
+                    "height": peer.blockchain.tip_height + 1,
+                    "hash": peer.blockchain.tip_hash_hex,
+                }).encode()
+            try:
+                with quietly():
+                    block_rate, stats_rate = rate(peer, get_block), rate(peer, stats)
+            finally:
+                peer.stop()
+            print(f"- {label:<17}: GET_BLOCK {block_rate:,.0f} replies/sec, STATS {stats_rate:,.0f} replies/sec")
+    finally:
+        client.close()
+
+
+def bench_gossip_memory(args):
+    """
+    Memory held by seen GOSSIP IDs after a long run, in a plain set (the
+    old gossip_seen) and in the bounded SeenCache, and tracked peers left
+    after most of them go silent.
+    """
+    # One GOSSIP ID per peer per interval, spread over the simulated run
+    ids = [str(uuid.uuid4()) for _ in range(args.ids)]
+    spacing = args.hours * 3600 / len(ids)
+
+    def measure(build):
+        tracemalloc.start()
+        seen = build()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return seen, size
+
+    def fill_cache():
+        cache = SeenCache(Peer.GOSSIP_SEEN_TTL, Peer.MAX_GOSSIP_SEEN)
+        for index, gossip_id in enumerate(ids):
+            cache.add(gossip_id, now=index * spacing)
+        return cache
+
+    plain, plain_size = measure(lambda: set(ids))
+    cache, cache_size = measure(fill_cache)
+    print(f"{len(ids):,} GOSSIP IDs over {args.hours} hours:")
+    print(f"- set      : {len(plain):>7,} IDs held, {plain_size / 1024:,.0f} KiB")
+    print(f"- SeenCache: {len(cache):>7,} IDs held, {cache_size / 1024:,.0f} KiB, {cache.summary()}")
+
+    peer = Peer('127.0.0.1', 0)
+    try:
+        with quietly():
+            for index in range(args.peers):
+                # Replies go to a port nobody reads
+                peer.handle_gossip({"type": "GOSSIP", "host": "10.0.0.1", "port": index + 1,
+                                    "id": str(uuid.uuid4()), "name": "Gossiper"}, ('127.0.0.1', 9))
+            silent = random.sample(sorted(peer.peer_last_seen), args.peers * 9 // 10)
+            for tracked in silent:
+                peer.peer_last_seen[tracked] -= peer.PEER_TIMEOUT + 1
+            peer.evict_silent_peers()
+    finally:
+        peer.sock.close()
+    gossip = peer.get_metrics()["gossip"]
+    print(f"- {args.peers} peers gossiped, {len(silent)} went silent: {gossip['tracked_peers']} still tracked, "
+          f"{gossip['peers_evicted']} evicted")
+
+
+def bench_gossip_sim(args):
+    """
+    Spread one GOSSIP through networks of in-process peers on a
+    SimulatedNetwork, after a few rounds of periodic gossip have let the
+    peers learn about each other. Reports how many peers it reached, how
+    long that took and how many datagrams it cost, for each fan-out and
+    with forwarding turned off (the old behaviour).
+    """
+    interval = Peer.GOSSIP_INTERVAL
+    print(f"One GOSSIP after {args.warmup_rounds} gossip rounds, {args.drop_rate:.0%} loss:")
+    for size in args.sizes:
+        runs = [(f"fan-out {fanout}", fanout, True) for fanout in args.fanouts]
+        runs.append(("no forwarding", Peer.MAX_PEERS_TO_GOSSIP, False))
+        for label, fanout, forwarding in runs:
+            network = SimulatedNetwork(drop_rate=args.drop_rate)
+            peers = [Peer('127.0.0.1', 0) for _ in range(size)]
+            addresses = [(f"peer{index}", 8999) for index in range(size)]
+            for peer, address in zip(peers, addresses):
+                network.attach(peer, address)
+                peer.well_known_peers = addresses[:3]
+                peer.MAX_PEERS_TO_GOSSIP = fanout
+                if not forwarding:
+                    peer.forward_gossip = lambda message, exclude: None
+
+            def gossip_round(peer):
+                peer.send_gossip()
+                network.schedule(peer.gossip_delay(), lambda: gossip_round(peer))
+
+            for peer in peers:
+                network.schedule(random.uniform(0, interval), lambda peer=peer: gossip_round(peer))
+            network.run_until(args.warmup_rounds * interval)
+
+            # Note when each peer first hears the watched GOSSIP
+            reached = {}
+            for peer in peers:
+                def tracking(message, addr, peer=peer, handle=peer.handle_gossip):
+                    if message.get("id") == network.watched_id and peer not in reached:
+                        reached[peer] = network.now
+                    handle(message, addr)
+                peer.handle_gossip = tracking
+            origin = random.choice(peers)
+            started = network.now
+            network.watched_id = str(uuid.uuid4())
+            origin.gossip_seen.add(network.watched_id)
+            message = {"type": "GOSSIP", "host": origin.host, "port": origin.port,
+                       "id": network.watched_id, "name": origin.name}
+            for peer in origin.well_known_peers:
+                origin.send_message(message, peer)
+            origin.forward_gossip(message, exclude={(origin.host, origin.port)})
+            reached[origin] = started
+            network.run_until(started + interval / 2)
+
+            times = sorted(reached_at - started for reached_at in reached.values())
+            needed = math.ceil(0.99 * size)
+            p99 = times[needed - 1] if len(times) >= needed else None
+            tracked = sum(len(peer.tracked_peers) for peer in peers) / size
+            print(f"- {size:>4} peers, {label:<13}: reached {len(reached) / size:6.1%}, "
+                  f"99% after {f'{p99 * 1000:.0f} ms' if p99 is not None else 'never':>8}, "
+                  f"all after {f'{times[-1] * 1000:.0f} ms' if len(reached) == size else 'never':>8}, "
+                  f"{network.watched_sends / size:.1f} datagrams per peer, {tracked:.0f} peers tracked on average")
+            for peer in peers:
+                peer.sock.close()
+
+
+def bench_consensus_poll(args):
+    """
+    Consensus against one live stand-in peer and a number of peers that
+    never answer, with the shared-deadline STATS poll and with the old
+    sequential one, which also kept mining paused from the first request.
+    Covers a peer that is up to date and one that is behind. Exits non-zero
+    if a consensus does not end on the served chain.
+    """
+    served = synthetic_chain(args.blocks)
+    source = StandInPeer(served)
+    try:
+        for dead_count in args.dead:
+            # Bound but never read, like a peer that has hung
+            dead = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(dead_count)]
+            for sock in dead:
+                sock.bind(('127.0.0.1', 0))
+            print(f"1 live peer, {dead_count} silent:")
+            for situation, local_chain in (("up to date", served), ("behind", served[:-args.new_blocks])):
+                for label, legacy in (("parallel poll", False), ("sequential poll", True)):
+                    peer = Peer('127.0.0.1', 0)
+                    peer.blockchain.DIFFICULTY = 1
+                    peer.blockchain.replace_chain(list(local_chain))
+                    peer.well_known_peers = [sock.getsockname() for sock in dead] + [source.address]
+                    peer.fetch_peers = None
+                    if legacy:
+                        peer.poll_peer_stats = lambda peers: legacy_poll_peer_stats(peer, peers, args.legacy_timeout)
+                    start = time.time()
+                    with quietly():
+                        peer.perform_consensus()
+                    elapsed = time.time() - start
+                    peer.sock.close()
+                    if peer.blockchain.chain != served:
+                        raise SystemExit(f"{label}, {situation}: consensus did not end on the served chain")
+                    # The old consensus paused mining before it sent the first STATS
+                    paused = elapsed if legacy else peer.last_consensus_pause
+                    print(f"- {situation:<10}, {label:<15}: consensus took {elapsed:6.2f}s, mining paused {paused:6.2f}s")
+            for sock in dead:
+                sock.close()
+    finally:
+        source.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sardukar microbenchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    hashrate = subparsers.add_parser("hashrate", help="Mining kernel hashes/sec per core")
+    hashrate.add_argument("--nonces", type=int, default=500000, help="Nonces to hash per kernel")
+    hashrate.set_defaults(func=bench_hashrate)
+
+    verify_mining = subparsers.add_parser("verify-mining", help="Check mined blocks pass is_valid_block")
+    verify_mining.add_argument("--blocks", type=int, default=200, help="Random blocks to mine")
+    verify_mining.add_argument("--difficulty", type=int, default=2, help="Trailing zero hex digits")
+    verify_mining.set_defaults(func=bench_verify_mining)
+
+    partition = subparsers.add_parser("partition", help="Check nodes never search the same nonces")
+    partition.add_argument("--nodes", type=int, default=8, help="Machines mining under one name")
+    partition.add_argument("--workers", type=int, default=4, help="Workers per machine")
+    partition.add_argument("--restarts", type=int, default=5, help="Restarts per worker")
+    partition.add_argument("--chunks", type=int, default=10, help="Chunks per worker run before and after the re-send")
+    partition.set_defaults(func=bench_partition)
+
+    fetch = subparsers.add_parser("fetch", help="Blocks/sec syncing from local stand-in peers")
+    fetch.add_argument("--blocks", type=int, default=5000, help="Length of the served chain")
+    fetch.add_argument("--peers", type=int, default=3, help="Stand-in peers serving it")
+    fetch.add_argument("--drop-rate", type=float, default=0.01, help="Fraction of requests each peer ignores")
+    fetch.add_argument("--window", type=int, default=BlockchainFetcher.WINDOW_SIZE, help="Requests in flight")
+    fetch.add_argument("--slow-peers", type=int, default=0, help="Extra stand-in peers that answer slowly")
+    fetch.add_argument("--slow-delay", type=float, default=0.005, help="Seconds a slow peer takes per request")
+    fetch.add_argument("--dead-peers", type=int, default=0, help="Extra peers that never answer")
+    fetch.add_argument("--bad-peers", type=int, default=0, help="Extra stand-in peers serving forged blocks")
+    fetch.add_argument("--legacy-peers", type=int, default=0, help="Extra stand-in peers that ignore GET_BLOCKS")
+    fetch.add_argument("--batch", type=int, default=BlockchainFetcher.BATCH_SIZE, help="Blocks per GET_BLOCKS request")
+    fetch.set_defaults(func=bench_fetch)
+
+    sync = subparsers.add_parser("sync", help="Requests sent by an incremental consensus run")
+    sync.add_argument("--blocks", type=int, default=5000, help="Length of the served chain")
+    sync.add_argument("--new-blocks", type=int, default=100, help="Blocks the syncing peer is behind")
+    sync.add_argument("--fork-depth", type=int, default=50, help="Blocks of the syncing peer's own fork")
+    sync.set_defaults(func=bench_sync)
+
+    validate = subparsers.add_parser("validate", help="Chain verification blocks/sec, serial vs parallel")
+    validate.add_argument("--blocks", type=int, default=100000, help="Length of the synthetic chain")
+    validate.add_argument("--processes", type=int, default=None, help="Worker processes (default: one per core)")
+    validate.set_defaults(func=bench_validate)
+
+    store = subparsers.add_parser("store", help="Chain store append rate and cold start time")
+    store.add_argument("--blocks", type=int, default=5000, help="Length of the synthetic chain")
+    store.set_defaults(func=bench_store)
+
+    memory = subparsers.add_parser("memory", help="Bytes per block, dicts vs Block records")
+    memory.add_argument("--blocks", type=int, default=20000, help="Length of the synthetic chain")
+    memory.set_defaults(func=bench_memory)
+
+    tip = subparsers.add_parser("tip", help="Tip validation and STATS replies/sec, cached vs recomputed")
+    tip.add_argument("--blocks", type=int, default=1000, help="Length of the synthetic chain")
+    tip.add_argument("--iterations", type=int, default=200000, help="Operations to time per variant")
+    tip.set_defaults(func=bench_tip)
+
+    forks = subparsers.add_parser("forks", help="Two peers converging on competing branches from announcements")
+    forks.add_argument("--blocks", type=int, default=1000, help="Length of the shared chain")
+    forks.add_argument("--fork-depth", type=int, default=20, help="Blocks each peer mined on its own branch")
+    forks.set_defaults(func=bench_forks)
+
+    latency = subparsers.add_parser("latency", help="GET_BLOCK p50/p99 while the peer runs consensus")
+    latency.add_argument("--blocks", type=int, default=10000, help="Length of the served chain; the peer has half")
+    latency.add_argument("--source-delay", type=float, default=0.005,
+                         help="Seconds the source peer takes per request, to stretch the sync")
+    latency.add_argument("--idle", type=float, default=1.0, help="Seconds of idle round trips measured first")
+    latency.set_defaults(func=bench_latency)
+
+    replies = subparsers.add_parser("replies", help="GET_BLOCK and STATS replies/sec, cached vs encoded per reply")
+    replies.add_argument("--blocks", type=int, default=2000, help="Length of the served chain")
+    replies.add_argument("--window", type=int, default=16, help="Requests kept outstanding")
+    replies.add_argument("--seconds", type=float, default=2.0, help="Seconds to measure each rate for")
+    replies.set_defaults(func=bench_replies)
+
+    gossip_memory = subparsers.add_parser("gossip-memory", help="Seen GOSSIP IDs and tracked peers over a long run")
+    gossip_memory.add_argument("--ids", type=int, default=200000, help="GOSSIP IDs received")
+    gossip_memory.add_argument("--hours", type=float, default=24, help="Hours they arrive over")
+    gossip_memory.add_argument("--peers", type=int, default=1000, help="Peers that gossip to us")
+    gossip_memory.set_defaults(func=bench_gossip_memory)
+
+    gossip_sim = subparsers.add_parser("gossip-sim", help="GOSSIP reach, time and datagrams across simulated peers")
+    gossip_sim.add_argument("--sizes", type=lambda text: [int(size) for size in text.split(",")],
+                            default=[50, 100, 200, 400], help="Comma-separated network sizes")
+    gossip_sim.add_argument("--fanouts", type=lambda text: [int(fanout) for fanout in text.split(",")],
+                            default=[3, Peer.MAX_PEERS_TO_GOSSIP], help="Comma-separated fan-outs to compare")
+    gossip_sim.add_argument("--warmup-rounds", type=int, default=2, help="Gossip rounds before the measured GOSSIP")
+    gossip_sim.add_argument("--drop-rate", type=float, default=0.0, help="Fraction of datagrams lost")
+    gossip_sim.set_defaults(func=bench_gossip_sim)
+
+    consensus_poll = subparsers.add_parser("consensus-poll", help="Consensus time and mining pause with silent peers")
+    consensus_poll.add_argument("--dead", type=lambda text: [int(count) for count in text.split(",")],
+                                default=[0, 1, 3], help="Comma-separated counts of silent peers")
+    consensus_poll.add_argument("--blocks", type=int, default=2000, help="Length of the served chain")
+    consensus_poll.add_argument("--new-blocks", type=int, default=200, help="Blocks the peer is behind by")
+    consensus_poll.add_argument("--legacy-timeout", type=float, default=5, help="Per-peer timeout of the old poll")
+    consensus_poll.set_defaults(func=bench_consensus_poll)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,65 @@
+import sys
+
+
+class Block:
+    """
+    One block of the chain, in a compact form.
+
+    Fields live in slots rather than a dict, the hash is kept as 32 raw
+    bytes and the messages as a tuple. Blocks only become JSON-ready dicts
+    at the edges: to_wire when they are sent or stored, from_wire when one
+    is received or loaded.
+    """
+    __slots__ = ('height', 'mined_by', 'messages', 'nonce', 'timestamp', 'hash')
+
+    def __init__(self, height, mined_by, messages, nonce, timestamp, hash=b''):
+        self.height = height
+        # Most blocks come from a handful of miners; share their name strings
+        self.mined_by = sys.intern(mined_by)
+        self.messages = tuple(messages)
+        self.nonce = nonce
+        self.timestamp = timestamp
+        self.hash = hash  # Raw 32-byte digest; empty until mined
+
+    @classmethod
+    def from_wire(cls, message):
+        """
+        Build a Block from a GET_BLOCK_REPLY or ANNOUNCE message.
+
+        Raises:
+            ValueError: If a field is missing or has the wrong type.
+        """
+        try:
+            height, mined_by, messages = message['height'], message['minedBy'], message['messages']
+            nonce, timestamp, block_hash = message['nonce'], message['timestamp'], bytes.fromhex(message['hash'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Malformed block: {e!r}")
+        if (not isinstance(height, int) or not isinstance(timestamp, int) or not isinstance(mined_by, str)
+                or not isinstance(nonce, str) or not isinstance(messages, list)
+                or not all(isinstance(msg, str) for msg in messages) or len(block_hash) != 32):
+            raise ValueError("Malformed block: a field has the wrong type")
+        return cls(height, mined_by, messages, nonce, timestamp, block_hash)
+
+    def to_wire(self, msg_type='GET_BLOCK_REPLY'):
+        """The block as a message dict ready for json.dumps."""
+        return {
+            'type': msg_type,
+            'height': self.height,
+            'minedBy': self.mined_by,
+            'messages': list(self.messages),
+            'nonce': self.nonce,
+            'timestamp': self.timestamp,
+            'hash': self.hash.hex(),
+        }
+
+    @property
+    def hash_hex(self):
+        return self.hash.hex()
+
+    def __eq__(self, other):
+        if not isinstance(other, Block):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        return f"Block(height={self.height}, minedBy={self.mined_by!r}, hash={self.hash.hex()})"
@@ -0,0 +1,74 @@
+import hashlib
+from functools import lru_cache
+
+
+def prev_hash_state(prev_hash):
+    """
+    Start a block hash: a sha256 object fed the previous block's hash.
+
+    Every block built on the same predecessor starts from this state, so it
+    can be kept and copied rather than re-encoding and re-hashing the hash.
+
+    Args:
+        prev_hash: Raw hash of the previous block, or None for the genesis
+            block. It is hashed in its hex form, as on the wire.
+    """
+    hash_base = hashlib.sha256()
+    # Genesis block has no previous hash
+    if prev_hash is not None:
+        hash_base.update(prev_hash.hex().encode())
+    return hash_base
+
+
+def hash_prefix(prev_hash, miner, messages, timestamp, prev_state=None):
+    """
+    Hash everything in a block except the nonce.
+
+    Args:
+        prev_hash: Raw hash of the previous block, or None for the genesis
+            block.
+        miner: The block's minedBy name.
+        messages: List of message strings.
+        timestamp: Integer block timestamp.
+        prev_state: prev_hash_state(prev_hash), if the caller has it cached.
+
+    Returns:
+        A hashlib sha256 object that can be copied and fed a nonce.
+    """
+    hash_base = prev_state.copy() if prev_state is not None else prev_hash_state(prev_hash)
+    hash_base.update(miner.encode())
+    for msg in messages:
+        hash_base.update(msg.encode())
+    hash_base.update(timestamp.to_bytes(8, 'big'))
+    return hash_base
+
+
+def block_digest(prev_hash, block, prev_state=None):
+    """Calculate the raw 32-byte hash of a Block given its predecessor's raw hash."""
+    hash_base = hash_prefix(prev_hash, block.mined_by, block.messages, block.timestamp, prev_state)
+    hash_base.update(block.nonce.encode())
+    return hash_base.digest()
+
+
+@lru_cache(maxsize=None)
+def difficulty_target(difficulty):
+    """
+    Translate "the hex hash ends in `difficulty` zeros" to raw digest terms.
+
+    Each byte is two hex digits, so the digest must end in difficulty // 2
+    zero bytes. An odd difficulty also needs the low nibble of the byte
+    before those to be zero.
+
+    Returns:
+        (zero_suffix, nibble_index): the zero bytes the digest must end with,
+        and the index of the byte whose low nibble must be zero (None for an
+        even difficulty).
+    """
+    full_bytes, half_byte = divmod(difficulty, 2)
+    nibble_index = -full_bytes - 1 if half_byte else None
+    return bytes(full_bytes), nibble_index
+
+
+def meets_difficulty(digest, zero_suffix, nibble_index):
+    """Check a raw digest against a target from difficulty_target()."""
+    return digest.endswith(zero_suffix) and (nibble_index is None or not digest[nibble_index] & 0x0F)
@@ -0,0 +1,197 @@
+import threading
+from collections import Counter, OrderedDict
+from BlockHash import difficulty_target, meets_difficulty
+
+# What add_block did with a block
+EXTENDED = "extended"  # Appended to the main chain's tip
+SIDE = "side"  # Kept on a side branch that is not longer than the main chain
+REORG = "reorg"  # Made a side branch the longest, so the main chain switched to it
+ORPHAN = "orphan"  # Parent unknown; kept until it arrives
+AHEAD = "ahead"  # Parent unknown and too far past the tip to buffer; left for consensus
+DUPLICATE = "duplicate"  # Already known
+STALE = "stale"  # Forks off deeper than MAX_FORK_DEPTH
+INVALID = "invalid"  # Fails proof of work
+
+
+class BlockTree:
+    """
+    Competing branches kept next to a Blockchain's main chain.
+
+    The main chain stays in blockchain.chain. Blocks that do not extend its
+    tip are kept here by hash: side-branch blocks, whose parent is known,
+    and orphans, whose parent has not arrived yet. Blocks do not carry their
+    parent's hash, so a block's parent is whichever known block one height
+    down its hash validates against.
+
+    The longest branch wins. When a side branch outgrows the main chain, the
+    main chain is rolled back to the fork and the branch is replayed on top
+    of it; the rolled back blocks become a side branch in turn.
+    """
+    MAX_FORK_DEPTH = 100  # Side blocks this far below the tip are forgotten
+    MAX_ORPHANS = 256  # Orphans waiting for a parent; past this, the biggest sender's oldest is dropped
+    MAX_ORPHAN_LEAD = 16  # Orphans further past the tip than this are left for consensus to fetch
+
+    def __init__(self, blockchain):
+        self.blockchain = blockchain
+        # Taken around every change to the main chain, so announcements, mined
+        # blocks and consensus never interleave
+        self.lock = threading.RLock()
+        self.side = {}  # hash -> (block, parent hash)
+        self.side_heights = {}  # height -> hashes of side blocks at that height
+        self.orphans = OrderedDict()  # hash -> block, oldest first
+        self.orphan_sources = {}  # hash -> address the orphan came from (None for our own), oldest first
+        self.reorgs = 0
+        self.rolled_back = 0  # Main chain blocks undone by reorgs
+
+    def add_block(self, block, source=None):
+        """
+        Place a block from an announcement or the miner wherever it fits.
+
+        Args:
+            source: Address the block was announced from, so a peer flooding
+                us with orphans only pushes out its own.
+
+        Returns:
+            One of the outcome constants at the top of this module.
+        """
+        with self.lock:
+            chain = self.blockchain.chain
+            if block.height <= 0:
+                return INVALID
+            if ((block.height < len(chain) and chain[block.height].hash == block.hash)
+                    or block.hash in self.side or block.hash in self.orphans):
+                return DUPLICATE
+            if block.height <= self.blockchain.tip_height - self.MAX_FORK_DEPTH:
+                return STALE
+            if not meets_difficulty(block.hash, *difficulty_target(self.blockchain.DIFFICULTY)):
+                return INVALID
+
+            parent = self.find_parent(block)
+            if parent is None:
+                if block.height > self.blockchain.tip_height + self.MAX_ORPHAN_LEAD:
+                    return AHEAD
+                self.orphans[block.hash] = block
+                self.orphan_sources[block.hash] = source
+                if len(self.orphans) > self.MAX_ORPHANS:
+                    # An orphan's hash is only proven once its parent arrives, and
+                    # forging one is free, so make room from whoever sent the most
+                    counts = Counter(self.orphan_sources.values())
+                    flooder = max(counts, key=counts.get)
+                    self.drop_orphan(next(orphan_hash for orphan_hash, sender in self.orphan_sources.items()
+                                          if sender == flooder))
+                return ORPHAN
+
+            outcome = self.link(block, parent)
+            linked = [block] + self.adopt_orphans(block)
+            best = max(linked, key=lambda linked_block: linked_block.height)
+            if best.hash in self.side and best.height > self.blockchain.tip_height and self.switch_to(best):
+                outcome = REORG
+            self.prune()
+            return outcome
+
+    def find_parent(self, block):
+        """Find the known block, main chain or side, that `block` was mined on."""
+        candidates = []
+        if block.height - 1 <= self.blockchain.tip_height:
+            candidates.append(self.blockchain.chain[block.height - 1])
+        candidates.extend(self.side[block_hash][0] for block_hash in self.side_heights.get(block.height - 1, ()))
+        for candidate in candidates:
+            if self.blockchain.calculate_digest(block, candidate) == block.hash:
+                return candidate
+        return None
+
+    def missing_height(self, orphan):
+        """The height of the block `orphan` is waiting on, below any orphans it already descends from."""
+        with self.lock:
+            lowest = orphan
+            while True:
+                parent = next((candidate for candidate in self.orphans.values()
+                               if candidate.height == lowest.height - 1
+                               and self.blockchain.calculate_digest(lowest, candidate) == lowest.hash), None)
+                if parent is None:
+                    return lowest.height - 1
+                lowest = parent
+
+    def link(self, block, parent):
+        """Attach `block` under its parent: on the tip it extends the main chain, elsewhere it starts or grows a side branch."""
+        if parent is self.blockchain.tip:
+            self.blockchain.append_block(block)
+            return EXTENDED
+        self.side[block.hash] = (block, parent.hash)
+        self.side_heights.setdefault(block.height, []).append(block.hash)
+        return SIDE
+
+    def adopt_orphans(self, block):
+        """Link every buffered orphan that descends from `block`, returning them."""
+        adopted = []
+        parents = [block]
+        while parents:
+            parent = parents.pop()
+            for orphan in [orphan for orphan in self.orphans.values() if orphan.height == parent.height + 1]:
+                if self.blockchain.calculate_digest(orphan, parent) == orphan.hash:
+                    self.drop_orphan(orphan.hash)
+                    self.link(orphan, parent)
+                    adopted.append(orphan)
+                    parents.append(orphan)
+        return adopted
+
+    def switch_to(self, branch_tip):
+        """
+        Make the side branch ending at `branch_tip` the main chain.
+
+        Only the blocks past the fork change: the main chain's are moved to
+        the side branches and the branch's are appended in their place. Every
+        block was validated when it was linked, so none is hashed again.
+
+        Returns:
+            False if the branch no longer joins the main chain (consensus
+            replaced the blocks it forked from).
+        """
+        branch = []
+        block_hash = branch_tip.hash
+        while block_hash in self.side:
+            block, block_hash = self.side[block_hash]
+            branch.append(block)
+        branch.reverse()
+        fork_height = branch[0].height - 1
+        chain = self.blockchain.chain
+        if chain[fork_height].hash != block_hash:
+            return False
+
+        rolled_back = chain[fork_height + 1:]
+        for block in branch:
+            del self.side[block.hash]
+            self.side_heights[block.height].remove(block.hash)
+        for block in rolled_back:
+            self.side[block.hash] = (block, chain[block.height - 1].hash)
+            self.side_heights.setdefault(block.height, []).append(block.hash)
+        # Tip listeners move the miner onto the new tip
+        self.blockchain.replace_chain(chain[:fork_height + 1] + branch, start=fork_height + 1)
+        self.reorgs += 1
+        self.rolled_back += len(rolled_back)
+        print(f"Switched to a longer branch forking at height {fork_height}: "
+              f"rolled back {len(rolled_back)} blocks, replayed {len(branch)}.")
+        return True
+
+    def prune(self):
+        """Forget side blocks and orphans too deep below the tip to ever win."""
+        floor = self.blockchain.tip_height - self.MAX_FORK_DEPTH
+        for height in [height for height in self.side_heights if height <= floor]:
+            for block_hash in self.side_heights.pop(height):
+                del self.side[block_hash]
+        for block_hash in [block_hash for block_hash, orphan in self.orphans.items() if orphan.height <= floor]:
+            self.drop_orphan(block_hash)
+
+    def drop_orphan(self, block_hash):
+        """Forget one orphan and where it came from."""
+        del self.orphans[block_hash]
+        del self.orphan_sources[block_hash]
+
+    def summary(self):
+        """Counters for METRICS."""
+        return {
+            "side_blocks": len(self.side),
+            "orphans": len(self.orphans),
+            "reorgs": self.reorgs,
+            "rolled_back": self.rolled_back,
+        }
@@ -1,6 +1,8 @@
-import hashlib
 import time
 import json
+from Block import Block
+from BlockHash import block_digest, difficulty_target, meets_difficulty, prev_hash_state
+from ChainValidator import first_invalid_block
 
 
 class Blockchain:
@@ -11,61 +13,89 @@ class Blockchain:
 
     def __init__(self):
         self.chain = []
+        self.tip_listeners = []  # Callbacks run whenever the chain tip changes
+        self.store = None  # ChainStore the chain is saved to, if any
+        # Tip state, kept current by refresh_tip() whenever the chain changes
+        self.tip = None
+        self.tip_height = -1
+        self.tip_hash_hex = None
+        self.tip_hash_state = None  # sha256 already fed the tip's hash; every next block starts here
         self.create_genesis_block()
 
     def create_genesis_block(self):
         """Create the predefined genesis block with a hardcoded hash."""
-        genesis_block = {
-            'type': 'GET_BLOCK_REPLY',
-            'height': 0,
-            'messages': ['Keep it', 'simple.', 'Veni', 'vidi', 'vici'],
-            'minedBy': 'Prof!',
-            'nonce': '663135608617883',
-            'timestamp': 1730910874,
-            'hash': '75977fa09516d028befa0695e16c93be20271b66630236d38718e35700000000'
-        }
+        genesis_block = Block(
+            height=0,
+            mined_by='Prof!',
+            messages=['Keep it', 'simple.', 'Veni', 'vidi', 'vici'],
+            nonce='663135608617883',
+            timestamp=1730910874,
+            hash=bytes.fromhex('75977fa09516d028befa0695e16c93be20271b66630236d38718e35700000000')
+        )
         self.chain.append(genesis_block)
-
-    def calculate_hash(self, block):
-        """Calculate the hash for a block."""
-        hash_base = hashlib.sha256()
+        self.refresh_tip()
+
+    def refresh_tip(self):
+        """Recompute the cached tip state after the chain changed."""
+        self.tip = self.chain[-1] if self.chain else None
+        self.tip_height = len(self.chain) - 1
+        if self.tip is None:
+            self.tip_hash_hex = self.tip_hash_state = None
+            return
+        self.tip_hash_hex = self.tip.hash_hex
+        self.tip_hash_state = prev_hash_state(self.tip.hash)
+
+    def calculate_digest(self, block, prev_block=None):
+        """Calculate the raw 32-byte hash for a block."""
+        prev_hash = None
         # Dynamically validate against the implicit "previous_hash"
-        if block['height'] > 0:  # Genesis block has no previous hash
-            last_block = self.chain[block['height'] - 1]
-            hash_base.update(last_block['hash'].encode())
-        # Add miner name
-        hash_base.update(block['minedBy'].encode())
-        # Add messages
-        for msg in block['messages']:
-            hash_base.update(msg.encode())
-        # Add timestamp
-        hash_base.update(block['timestamp'].to_bytes(8, 'big'))
-        # Add nonce
-        hash_base.update(block['nonce'].encode())
-        return hash_base.hexdigest()
-
-    def is_valid_block(self, block, prev_block):
-        """Check if a block is valid."""
-        print(f"Validating block with height {block['height']} (previous block height {prev_block['height']})")
-        if block['height'] == 0:  # Skip validation for genesis block
+        if block.height > 0:  # Genesis block has no previous hash
+            if prev_block is None:
+                prev_block = self.chain[block.height - 1]
+            prev_hash = prev_block.hash
+            # Blocks almost always extend the tip, whose hash state is cached
+            if prev_block is self.tip:
+                return block_digest(prev_hash, block, self.tip_hash_state)
+        return block_digest(prev_hash, block)
+
+    def calculate_hash(self, block, prev_block=None):
+        """Calculate the hash for a block."""
+        return self.calculate_digest(block, prev_block).hex()
+
+    def is_valid_block(self, block, prev_block, verbose=True):
+        """Check if a block is valid. Failures are printed even if not verbose."""
+        if verbose:
+            print(f"Validating block with height {block.height} (previous block height {prev_block.height})")
+        if block.height == 0:  # Skip validation for genesis block
             return True
         # Validate previous block's hash dynamically
-        if block['height'] > 0:
-            expected_previous_hash = prev_block['hash']
-            if expected_previous_hash != prev_block['hash']:
-                print(f"Previous block hash mismatch: {expected_previous_hash} != {prev_block['hash']}")
+        if block.height > 0:
+            expected_previous_hash = prev_block.hash
+            if expected_previous_hash != prev_block.hash:
+                print(f"Previous block hash mismatch: {expected_previous_hash.hex()} != {prev_block.hash_hex}")
                 return False
-        if not block['hash'].endswith('0' * self.DIFFICULTY):
-            print(f"Block hash does not meet difficulty: {block['hash']}")
+        # Work on the raw digest; hex is only built to report a failure
+        calculated_digest = self.calculate_digest(block, prev_block)
+        if not meets_difficulty(calculated_digest, *difficulty_target(self.DIFFICULTY)):
+            print(f"Block hash does not meet difficulty: {block.hash_hex}")
             return False
-        if self.calculate_hash(block) != block['hash']:
-            print(f"Hash mismatch: calculated {self.calculate_hash(block)} != {block['hash']}")
+        if calculated_digest != block.hash:
+            print(f"Hash mismatch: calculated {calculated_digest.hex()} != {block.hash_hex}")
             return False
         return True
 
-    def validate_fetched_chain(self, fetched_chain):
+    def first_invalid_height(self, fetched_chain, processes=None):
         """
-        Validate the entire fetched chain and print verification stats.
+        Find the first block of a fetched chain that fails validation.
+
+        Blocks are checked in parallel chunks (see ChainValidator).
+
+        Args:
+            processes: Worker processes to check with (default: one per core).
+
+        Returns:
+            The index of that block (0 if the genesis blocks differ), or None
+            if the whole chain is valid.
         """
         print(f"Local Genesis Block: {self.chain[0]}")
         print(f"Fetched Genesis Block: {fetched_chain[0]}")
@@ -73,44 +103,109 @@ class Blockchain:
         # Check if genesis blocks match
         if fetched_chain[0] != self.chain[0]:
             print("Fetched chain's genesis block does not match local genesis block!")
-            return False
+            return 0
 
-        valid = True
-        for i in range(1, len(fetched_chain)):
-            if not self.is_valid_block(fetched_chain[i], fetched_chain[i - 1]):
-                print(f"Fetched chain is invalid at block {i} (Height: {fetched_chain[i]['height']})")
-                valid = False
-                break
+        invalid_height = first_invalid_block(fetched_chain, 1, self.DIFFICULTY, processes)
+        if invalid_height is not None:
+            print(f"Fetched chain is invalid at block {invalid_height}")
+        return invalid_height
+
+    def validate_fetched_chain(self, fetched_chain):
+        """
+        Validate the entire fetched chain and print verification stats.
+        """
+        valid = self.first_invalid_height(fetched_chain) is None
         if valid:
             print("The entire fetched blockchain is verified successfully.")
             print(f"Blockchain Stats:")
             print(f"- Total Blocks: {len(fetched_chain)}")
-            print(f"- Last Block Hash: {fetched_chain[-1]['hash']}")
-            print(f"- Last Block Height: {fetched_chain[-1]['height']}")
-            print(f"- Mined By: {fetched_chain[-1]['minedBy']}")
+            print(f"- Last Block Hash: {fetched_chain[-1].hash_hex}")
+            print(f"- Last Block Height: {fetched_chain[-1].height}")
+            print(f"- Mined By: {fetched_chain[-1].mined_by}")
         return valid
 
     def add_block_from_response(self, response):
         """Add a block to the blockchain from a GET_BLOCK_REPLY response."""
         try:
-            block = json.loads(response)
-            if block["type"] != "GET_BLOCK_REPLY" or block["height"] is None:
+            message = json.loads(response)
+            if message["type"] != "GET_BLOCK_REPLY" or message["height"] is None:
                 raise ValueError("Invalid block data.")
-            
-            if len(self.chain) > 0:
-                prev_block = self.chain[-1]
-                if not self.is_valid_block(block, prev_block):
+            block = Block.from_wire(message)
+
+            if self.tip is not None:
+                if not self.is_valid_block(block, self.tip):
                     raise ValueError("Block is invalid or does not match chain.")
-            self.chain.append(block)
+            self.append_block(block)
         except (json.JSONDecodeError, KeyError, ValueError) as e:
             print(f"Error adding block from response: {e}")
 
+    def add_tip_listener(self, callback):
+        """Register `callback(tip_block)` to run whenever the chain tip changes."""
+        self.tip_listeners.append(callback)
+
+    def notify_tip_change(self):
+        """Tell every tip listener about the current tip."""
+        for callback in list(self.tip_listeners):
+            try:
+                callback(self.tip)
+            except Exception as e:
+                print(f"Error in tip listener: {e}")
+
+    def append_block(self, block):
+        """Append an already validated block and announce the new tip."""
+        self.chain.append(block)
+        self.refresh_tip()
+        if self.store is not None:
+            self.store.write(self.chain, len(self.chain) - 1)
+        self.notify_tip_change()
+
+    def replace_chain(self, chain, start=None):
+        """
+        Switch to an already validated chain and announce the new tip.
+
+        Args:
+            start: First height where `chain` differs from the current one,
+                if the caller knows it; saves comparing the chains to update
+                the store.
+        """
+        if start is None:
+            start = 0
+            while start < min(len(chain), len(self.chain)) and chain[start].hash == self.chain[start].hash:
+                start += 1
+        self.chain = chain
+        self.refresh_tip()
+        if self.store is not None:
+            self.store.write(self.chain, start)
+        self.notify_tip_change()
+
+    def attach_store(self, store):
+        """
+        Load the chain saved in `store` and keep the store in sync from now on.
+
+        Only blocks above the store's checkpoint are verified; the stored
+        chain is cut at the first one that fails.
+        """
+        chain, checkpoint = store.load()
+        start = 0
+        if chain and chain[0] == self.chain[0]:
+            invalid_height = first_invalid_block(chain, max(checkpoint + 1, 1), self.DIFFICULTY)
+            if invalid_height is not None:
+                print(f"Stored block {invalid_height} is invalid. Dropping it and every block after it.")
+                chain = chain[:invalid_height]
+            self.chain = chain
+            start = len(chain)
+            print(f"Loaded {len(chain)} blocks from {store.path} (verified {len(chain) - 1 - max(checkpoint, 0)} since the checkpoint).")
+        elif chain:
+            print(f"Stored chain in {store.path} has a different genesis block. Ignoring it.")
+        self.store = store
+        # Drops anything past a bad block, or writes a fresh chain
+        store.write(self.chain, start)
+        self.refresh_tip()
+        self.notify_tip_change()
+
     def validate_chain(self):
         """Validate the entire blockchain."""
-        for i in range(1, len(self.chain)):
-            if not self.is_valid_block(self.chain[i], self.chain[i - 1]):
-                return False
-        return True
+        return first_invalid_block(self.chain, 1, self.DIFFICULTY) is None
 
     def get_chain(self):
         """Get the entire blockchain."""
@@ -118,9 +213,9 @@ class Blockchain:
 
     def get_stats(self):
         """Get statistics about the blockchain."""
-        if not self.chain:
+        if self.tip is None:
             return {"height": 0, "hash": None}
-        return {"height": len(self.chain) - 1, "hash": self.chain[-1]['hash']}
+        return {"height": self.tip_height, "hash": self.tip_hash_hex}
 
 
 if __name__ == "__main__":
@@ -131,7 +226,7 @@ if __name__ == "__main__":
     blockchain.add_block_from_response(response)
 
     # Print chain
-    print(json.dumps(blockchain.get_chain(), indent=4))
+    print(json.dumps([block.to_wire() for block in blockchain.get_chain()], indent=4))
 
     # Check stats
     print(blockchain.get_stats())
@@ -1,110 +1,468 @@
 import socket
 import json
+import select
 import time
+from collections import Counter, deque
+from Block import Block
+from PeerScoreboard import PeerScoreboard
+
 
 class BlockchainFetcher:
-    def __init__(self, blockchain, max_retries=3, retry_delay=2):
+    # Remove this HardList if u want to actually get blocks from everyone - but network is really bad right now - and people aren;t sending blocks properly
+    FETCH_PEERS = [
+        ("silicon.cs.umanitoba.ca", 8999),
+        ("eagle.cs.umanitoba.ca", 8999),
+        ("hawk.cs.umanitoba.ca", 8999)
+    ]
+    WINDOW_SIZE = 64  # Blocks requested and not yet received at once
+    BATCH_SIZE = 32  # Consecutive blocks asked for in one GET_BLOCKS request
+
+    def __init__(self, blockchain, max_retries=3, window_size=WINDOW_SIZE, fetch_peers=FETCH_PEERS, scoreboard=None,
+                 batch_size=BATCH_SIZE):
         """
         Initialize the BlockchainFetcher.
-        
+
         Args:
             blockchain: The local blockchain object to update.
-            max_retries: Maximum number of retries for each block fetch.
-            retry_delay: Delay (in seconds) between retries.
+            max_retries: Maximum number of attempts for each block, per peer.
+            window_size: Number of blocks kept in flight at once.
+            fetch_peers: Peers to fetch from instead of the ones passed to
+                fetch_all_blocks, or None to use those.
+            scoreboard: PeerScoreboard to route requests by and update. Pass
+                the peer's own one so scores outlive this fetch.
+            batch_size: Most blocks per GET_BLOCKS request; 1 sends only
+                single-block GET_BLOCK requests.
         """
         self.blockchain = blockchain
         self.max_retries = max_retries
-        self.retry_delay = retry_delay
+        self.window_size = window_size
+        self.fetch_peers = fetch_peers
+        self.scoreboard = scoreboard if scoreboard is not None else PeerScoreboard()
+        self.batch_size = batch_size
+        self.requests = 0  # Requests sent, retransmissions included
+        self.names = {}  # Resolved peer address -> (host, port) it is scored under
+        self.sources = {}  # Height -> resolved address of the peer whose block was kept
+        self.bad_sources = set()  # Resolved addresses that served a block failing validation
+        self.lacking = {}  # Resolved address -> lowest height it said it does not have
+        self.tokens = {}  # Resolved address -> token it wants on our GET_BLOCKS requests
+        self.blocks_per_second = None  # Rate of the last fetch_all_blocks
+
+    def fetch_all_blocks(self, all_peers, longest_chain_peer, longest_chain_height, start_height=0):
+        """
+        Fetch, validate and append blocks start_height..longest_chain_height to the local chain.
+
+        Requests are pipelined: up to window_size blocks are kept in flight
+        across all peers over one non-blocking socket, replies are matched
+        back by height, and requests that outlive their peer's adaptive
+        timeout are retransmitted to another peer. Runs of consecutive
+        heights go to a peer as one GET_BLOCKS request, unless it has shown
+        it only speaks GET_BLOCK. Requests go to
+        whichever peer the scoreboard expects to answer soonest, so fast
+        peers carry more of the window and lossy ones are only probed.
+
+        Replies land in a reorder buffer, and each block is validated against
+        its predecessor as soon as that is in the chain. An invalid block is
+        dropped and re-requested from another peer mid-sync, so the chain is
+        fully validated the moment its last block arrives.
+
+        Args:
+            start_height: First height to fetch. The local chain should
+                already hold the blocks below it.
+
+        Returns:
+            True if every block was fetched. Otherwise the longest valid
+            prefix that arrived is appended and False is returned.
+        """
+        if self.fetch_peers is not None:
+            all_peers = self.fetch_peers
 
-    def fetch_all_blocks(self, all_peers, longest_chain_peer, longest_chain_height):
+        # The longest chain peer is always a candidate, even if all_peers is empty
+        start_time = time.time()
+        blocks = self.fetch_heights(list(all_peers) + [longest_chain_peer],
+                                    range(start_height, longest_chain_height + 1), self.append_if_valid)
+        if blocks is None:
+            return False
+        fetched = len(self.blockchain.chain)
 
-# Remove this HardList if u want to actually get blocks from everyone - but network is really bad right now - and people aren;t sending blocks properly 
-        all_peers = [
-    ("silicon.cs.umanitoba.ca", 8999),
-    ("eagle.cs.umanitoba.ca", 8999),
-    ("hawk.cs.umanitoba.ca", 8999)
-]
+        # Score each peer once per sync on whether any of its blocks were bad
+        for addr in set(self.sources.values()) | self.bad_sources:
+            self.scoreboard.record_block(self.name(addr), addr not in self.bad_sources)
 
-        # If there are no peers in all_peers, fallback directly to longest_chain_peer
-        if not all_peers:
-            all_peers = [longest_chain_peer]
+        elapsed = max(time.time() - start_time, 1e-9)
+        self.blocks_per_second = (fetched - start_height) / elapsed
+        print(f"Fetched {fetched - start_height} blocks in {elapsed:.2f}s ({self.blocks_per_second:.1f} blocks/sec).")
+        if fetched <= longest_chain_height:
+            print(f"Failed to fetch block {fetched} from all known peers including longest chain peer. Stopping fetch.")
+            # Timeouts prove nothing, but saying it lacks a block below its claimed tip does
+            lacked = [height for addr, height in self.lacking.items() if self.name(addr) == longest_chain_peer]
+            if lacked and min(lacked) <= longest_chain_height:
+                print(f"{longest_chain_peer[0]}:{longest_chain_peer[1]} claimed height {longest_chain_height} "
+                      f"but does not have block {min(lacked)}.")
+                self.scoreboard.record_false_tip(longest_chain_peer)
+            return False
+        return True
 
-        for height in range(longest_chain_height + 1):  # Assuming longest_chain_height is inclusive
-            block_fetched = False
+    def append_if_valid(self, height, block):
+        """Validator stage: append `block` to the local chain if it extends the tip."""
+        tip = self.blockchain.tip
+        # Without a predecessor there is nothing to link to (a sync from genesis)
+        if tip is not None and not self.blockchain.is_valid_block(block, tip, verbose=False):
+            return False
+        self.blockchain.append_block(block)
+        return True
 
-            
-            peers_to_try = [p for p in all_peers if p != longest_chain_peer]
+    def fetch_heights(self, peers, heights, validator=None):
+        """
+        Fetch the blocks at `heights` from `peers` through the request window.
+
+        Args:
+            heights: Sequence of heights, such as a range. It is read by
+                index as the window advances and never copied, so a huge
+                claimed tip costs nothing until blocks actually arrive.
+            validator: Optional callable(height, block) -> bool, run on each
+                block in height order once all before it passed. Blocks it
+                rejects are fetched again. `heights` must then be ascending.
 
-            # Round-robin pick a peer based on height (this ensures distribution)
-            if peers_to_try:
-                peer_index = height % len(peers_to_try)
-                selected_peer = peers_to_try[peer_index]
-                if self.try_fetch_block(selected_peer, height):
-                    block_fetched = True
+        Returns:
+            Dict of height -> block for every block that arrived, or None if
+            no peer could be resolved.
+        """
+        peers = self.resolve_peers(peers)
+        if not peers:
+            print("Could not resolve any peer to fetch from.")
+            return None
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            return self.fetch_window(sock, peers, heights, validator)
+        finally:
+            sock.close()
+
+    def find_fork_height(self, peer, local_chain, peer_height):
+        """
+        Find the highest block `peer`'s chain shares with `local_chain`.
+
+        Hashes are compared at a locator of exponentially spaced heights
+        below the lower of the two tips (tip, tip-1, tip-2, tip-4, ... 0),
+        all fetched in one window. A binary search between the highest
+        matching locator height and the next one up then pins the fork down,
+        so the whole search takes O(log height) round trips.
+
+        Returns:
+            The fork height (-1 if even the genesis blocks differ), or None
+            if the peer did not answer.
+        """
+        top = min(len(local_chain) - 1, peer_height)
+        locator = []
+        step = 1
+        height = top
+        while height > 0:
+            locator.append(height)
+            height -= step
+            if len(locator) > 2:
+                step *= 2
+        locator.append(0)
+
+        blocks = self.fetch_heights([peer], locator)
+        if blocks is None or len(blocks) < len(locator):
+            print(f"Could not fetch the block locator from {peer[0]}:{peer[1]}.")
+            return None
+
+        # Locator heights run from the tip down, so the first match is the highest one
+        matched = -1
+        mismatched = top + 1
+        for height in locator:
+            if blocks[height].hash == local_chain[height].hash:
+                matched = height
+                break
+            mismatched = height
+
+        # The fork lies between the highest match and the lowest mismatch above it
+        while mismatched - matched > 1:
+            middle = (matched + mismatched) // 2
+            blocks = self.fetch_heights([peer], [middle])
+            if not blocks:
+                print(f"Could not fetch block {middle} from {peer[0]}:{peer[1]} while locating the fork.")
+                return None
+            if blocks[middle].hash == local_chain[middle].hash:
+                matched = middle
+            else:
+                mismatched = middle
+        return matched
+
+    def resolve_peers(self, peers):
+        """
+        Resolve (host, port) pairs to the addresses replies will come from, dropping duplicates.
+
+        The name each address was first listed under is kept in self.names
+        for the scoreboard.
+        """
+        resolved = []
+        for peer_host, peer_port in peers:
+            try:
+                addr = (socket.gethostbyname(peer_host), peer_port)
+            except OSError as e:
+                print(f"Could not resolve {peer_host}: {e}")
+                continue
+            if addr not in resolved:
+                resolved.append(addr)
+                self.names[addr] = (peer_host, peer_port)
+        return resolved
+
+    def name(self, addr):
+        """The (host, port) a resolved address is scored under."""
+        return self.names.get(addr, addr)
+
+    def pick_peer(self, height, peers, lacking, avoid, load):
+        """
+        Choose a peer for `height` by score among peers that may have it.
+
+        Args:
+            lacking: Peer -> lowest height it has said it does not have.
+            avoid: Peers that already failed this height; used only as a last resort.
+            load: Peer -> requests currently in flight to it.
+
+        Returns:
+            A resolved peer address, or None if no peer may have the block.
+        """
+        candidates = [p for p in peers if lacking.get(p, float('inf')) > height]
+        fresh = [p for p in candidates if p not in avoid]
+        candidates = fresh or candidates
+        if not candidates:
+            return None
+        by_name = {self.name(p): p for p in candidates}
+        named_load = {self.name(p): count for p, count in load.items()}
+        choice = self.scoreboard.choose(list(by_name), named_load)
+        return by_name.get(choice)
+
+    def fetch_window(self, sock, peers, heights, validator=None):
+        """
+        Run the request window over `heights` until every one has arrived or given up.
+
+        Returns:
+            Dict of height -> block for every block that arrived (and passed
+            the validator, up to the first one that has not).
+        """
+        blocks = {}
+        in_flight = {}  # height -> (peer, send time, deadline, first attempt?, sent in a GET_BLOCKS?)
+        attempts = {}  # height -> peers that already failed it
+        lacking = self.lacking  # peer -> lowest height it replied "height: None" for
+        retry = deque()
+        next_new = 0  # Index into heights of the first height never requested
+        next_index = 0  # Index into heights of the next block for the validator
+        max_attempts = self.max_retries * len(peers)
+
+        def following(from_retry):
+            """The height queued after the one just taken, or None."""
+            if from_retry:
+                return retry[0] if retry else None
+            return heights[next_new] if next_new < len(heights) else None
+
+        while len(blocks) < len(heights):
+            load = Counter(request[0] for request in in_flight.values())
+            # Fill the window, retransmissions first
+            while len(in_flight) < self.window_size and (retry or next_new < len(heights)):
+                from_retry = bool(retry)
+                if from_retry:
+                    height = retry.popleft()
                 else:
-                    # If failed to fetch from the chosen peer, try others in `peers_to_try`:
-                    for peer in peers_to_try:
-                        if peer == selected_peer:
-                            continue
-                        if self.try_fetch_block(peer, height):
-                            block_fetched = True
+                    height = heights[next_new]
+                    next_new += 1
+                if height in blocks:
+                    continue
+                failed = attempts.setdefault(height, [])
+                if len(failed) >= max_attempts:
+                    print(f"Giving up on block {height}.")
+                    return blocks
+                peer = self.pick_peer(height, peers, lacking, failed, load)
+                if peer is None:
+                    print(f"Giving up on block {height}.")
+                    return blocks
+                batch = [height]
+                if self.batch_size > 1 and self.scoreboard.supports_batch(self.name(peer)) is not False:
+                    # The heights right after this one in the same queue ride along in one GET_BLOCKS
+                    while len(batch) < self.batch_size and len(in_flight) + len(batch) < self.window_size:
+                        upcoming = following(from_retry)
+                        if (upcoming != batch[-1] + 1 or upcoming in blocks
+                                or lacking.get(peer, float('inf')) <= upcoming
+                                or peer in attempts.get(upcoming, ())
+                                or len(attempts.get(upcoming, ())) >= max_attempts):
                             break
-
-            # If still not fetched, try the longest_chain_peer now
-            if not block_fetched:
-                if self.try_fetch_block(longest_chain_peer, height):
-                    block_fetched = True
+                        batch.append(upcoming)
+                        if from_retry:
+                            retry.popleft()
+                        else:
+                            next_new += 1
+                if len(batch) > 1:
+                    request = {"type": "GET_BLOCKS", "height": height, "count": len(batch)}
+                    if peer in self.tokens:
+                        request["token"] = self.tokens[peer]
                 else:
-                    print(f"Failed to fetch block {height} from all known peers including longest chain peer. Stopping fetch.")
-                    return
+                    request = {"type": "GET_BLOCK", "height": height}
+                now = time.time()
+                self.requests += 1
+                try:
+                    sock.sendto(json.dumps(request).encode(), peer)
+                except OSError as e:
+                    print(f"Error requesting block {height} from {peer[0]}:{peer[1]}: {e}")
+                    for failed_height in batch:
+                        attempts.setdefault(failed_height, []).append(peer)
+                        retry.append(failed_height)
+                    continue
+                deadline = now + self.scoreboard.rto(self.name(peer))
+                for batch_height in batch:
+                    first_attempt = not attempts.setdefault(batch_height, [])
+                    in_flight[batch_height] = (peer, now, deadline, first_attempt, len(batch) > 1)
+                load[peer] += len(batch)
+
+            if not in_flight:
+                continue
+            # Sleep until a reply arrives or the earliest request times out
+            wait = max(0, min(request[2] for request in in_flight.values()) - time.time())
+            readable, _, _ = select.select([sock], [], [], wait)
+            if readable:
+                self.receive_replies(sock, blocks, in_flight, attempts, lacking, retry)
+                if validator is not None:
+                    next_index = self.validate_ready(blocks, heights, next_index, attempts, retry, validator)
 
-    def try_fetch_block(self, peer, height):
+            now = time.time()
+            lost = set()  # (peer, send time, batched?) of each request with a block that timed out
+            for height, (peer, sent, deadline, _, batched) in list(in_flight.items()):
+                if deadline <= now:
+                    del in_flight[height]
+                    attempts[height].append(peer)
+                    lost.add((peer, sent, batched))
+                    print(f"Timeout fetching block {height} from {peer[0]}:{peer[1]}. Retrying "
+                          f"{len(attempts[height])}/{max_attempts}...")
+                    retry.append(height)
+            # A lost GET_BLOCKS is one loss, not one per block it asked for
+            for peer, _, batched in lost:
+                self.scoreboard.record_loss(self.name(peer))
+                if batched:
+                    self.scoreboard.record_batch_loss(self.name(peer))
+        return blocks
+
+    def validate_ready(self, blocks, heights, next_index, attempts, retry, validator):
         """
-        Attempt to fetch a single block from a given peer.
-        
-        Args:
-            peer: Tuple (host, port) of the peer to fetch from.
-            height: The height of the block to fetch.
-        
+        Feed the validator every buffered block whose predecessor has passed.
+
+        A rejected block is taken out of the buffer, its peer is marked as
+        having failed that height, and the height goes to the front of the
+        retry queue. Every other buffered block from that peer goes back
+        with it, so a bad batch is re-requested as one run instead of being
+        rejected a block at a time.
+
         Returns:
-            True if the block was successfully fetched and appended to the local blockchain, False otherwise.
+            The index into heights of the next block still to validate.
         """
-        peer_host, peer_port = peer
-        message = {"type": "GET_BLOCK", "height": height}
-        retries = 0
+        while next_index < len(heights) and heights[next_index] in blocks:
+            height = heights[next_index]
+            if validator(height, blocks[height]):
+                next_index += 1
+                continue
+            addr = self.sources[height]
+            self.bad_sources.add(addr)
+            suspect = sorted(h for h in blocks if h >= height and self.sources.get(h) == addr)
+            for suspect_height in reversed(suspect):
+                del blocks[suspect_height]
+                del self.sources[suspect_height]
+                attempts[suspect_height].append(addr)
+                retry.appendleft(suspect_height)
+            print(f"Block {height} from {addr[0]}:{addr[1]} is invalid. Requesting it and "
+                  f"{len(suspect) - 1} more blocks from that peer again.")
+            break
+        return next_index
 
-        while retries < self.max_retries:
-            sock = None
+    def receive_replies(self, sock, blocks, in_flight, attempts, lacking, retry):
+        """Drain every queued GET_BLOCK_REPLY and GET_BLOCKS_REPLY and match their blocks to requests by height."""
+        while True:
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.settimeout(5)
-                sock.sendto(json.dumps(message).encode(), (peer_host, peer_port))
-                response, _ = sock.recvfrom(4096)
-                block = json.loads(response.decode())
-
-                if block["height"] is None:  # No more blocks available from this peer
-                    # This peer doesn't have the block. Return False so we can try another peer.
-                    return False
-
-                # Add the fetched block to the local blockchain
-                self.blockchain.chain.append(block)
-                print(f"Added block {block['height']} from {peer_host}:{peer_port}")
-                return True
-
-            except socket.timeout:
-                retries += 1
-                print(f"Timeout fetching block {height} from {peer_host}:{peer_port}. Retrying {retries}/{self.max_retries}...")
-                time.sleep(self.retry_delay)
-
-            except Exception as e:
-                print(f"Error fetching block {height} from {peer_host}:{peer_port}: {e}")
-                # This peer failed; don't retry more than max_retries times
-                return False
-
-            finally:
-                if sock:
-                    sock.close()
-
-        # If I have exhausted retries, return False
-        print(f"Failed to fetch block {height} from {peer_host}:{peer_port} after {self.max_retries} attempts.")
-        return False
+                response, addr = sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. ICMP port unreachable from a dead peer; its requests will time out
+                print(f"Error receiving block: {e}")
+                continue
+            try:
+                message = json.loads(response.decode())
+                height = message["height"]
+            except (ValueError, KeyError, TypeError):
+                continue
+
+            if message.get("type") == "GET_BLOCKS_REPLY":
+                self.receive_batch(message, addr, blocks, in_flight, attempts, lacking, retry)
+                continue
+
+            if height is None:
+                # This peer is missing a block; the reply does not say which, so
+                # assume its highest outstanding one and send that elsewhere.
+                self.scoreboard.record_reply(self.name(addr))
+                mine = [h for h, request in in_flight.items() if request[0] == addr]
+                if mine:
+                    missing = max(mine)
+                    lacking[addr] = min(lacking.get(addr, missing), missing)
+                    del in_flight[missing]
+                    retry.append(missing)
+                continue
+
+            self.receive_block(message, addr, blocks, in_flight, attempts, retry)
+
+    def receive_batch(self, message, addr, blocks, in_flight, attempts, lacking, retry):
+        """
+        Take the blocks of one GET_BLOCKS_REPLY datagram.
+
+        A reply to one request may span several datagrams. Each lists
+        consecutive blocks from "height" on, and its "next" is None once
+        the peer's chain ends, so the rest of what was asked for is sent
+        elsewhere straight away.
+        """
+        self.scoreboard.record_batch_reply(self.name(addr))
+        start, batch = message["height"], message.get("blocks")
+        if not isinstance(start, int) or not isinstance(batch, list):
+            return
+        if isinstance(message.get("token"), str) and not batch and message.get("next") == start:
+            # The peer wants its token before it sends blocks: ask again with it straight away
+            self.tokens[addr] = message["token"]
+            request = in_flight.get(start)
+            if request is not None and request[0] == addr:
+                resend = sorted(h for h, other in in_flight.items() if other[0] == addr and other[1] == request[1])
+                for height in reversed(resend):
+                    del in_flight[height]
+                    retry.appendleft(height)
+            return
+        for block_message in batch:
+            if isinstance(block_message, dict):
+                self.receive_block(block_message, addr, blocks, in_flight, attempts, retry)
+        if message.get("next") is None:
+            end = start + len(batch)  # First height the peer does not have
+            self.scoreboard.record_reply(self.name(addr))
+            lacking[addr] = min(lacking.get(addr, end), end)
+            for missing in [h for h, request in in_flight.items() if request[0] == addr and h >= end]:
+                del in_flight[missing]
+                retry.append(missing)
+
+    def receive_block(self, message, addr, blocks, in_flight, attempts, retry):
+        """Take one block from a reply, if it is one we asked for and do not have yet."""
+        height = message.get("height")
+        if not isinstance(height, int) or height in blocks or height not in attempts:
+            return
+        rtt = None
+        request = in_flight.pop(height, None)
+        if request is not None:
+            peer, sent, _, first_attempt, _ = request
+            # Karn's rule: only time requests that were never retransmitted
+            if peer == addr and first_attempt:
+                rtt = time.time() - sent
+        self.scoreboard.record_reply(self.name(addr), rtt)
+        try:
+            block = Block.from_wire(message)
+        except ValueError as e:
+            print(f"Block {height} from {addr[0]}:{addr[1]} is malformed ({e}). Requesting it again.")
+            self.bad_sources.add(addr)
+            attempts[height].append(addr)
+            retry.appendleft(height)
+            return
+        # Late replies to timed-out requests are still good blocks
+        blocks[height] = block
+        self.sources[height] = addr
@@ -0,0 +1,119 @@
+import json
+import sqlite3
+import threading
+import time
+from Block import Block
+
+
+class ChainStore:
+    """
+    On-disk copy of the chain in SQLite, one row per height.
+
+    Writes are grouped into transactions, so one fsync covers a batch of
+    blocks. write() only queues the blocks in memory and never touches the
+    database, so it is cheap on the event loop. flush_if_due(), which the
+    peer runs off the loop, writes the queue out and commits it.
+
+    A checkpoint height is kept next to the blocks. Everything up to it was
+    verified before it was written, and only the blocks above it are
+    re-verified when the store is loaded.
+    """
+    SYNC_BATCH = 100  # Blocks queued before flush_if_due commits them without waiting
+    SYNC_INTERVAL = 5  # Seconds since the last commit before flush_if_due commits any queued block
+    CHECKPOINT_BLOCKS = 1000  # Committed blocks the checkpoint may trail the tip by
+
+    def __init__(self, path):
+        self.path = path
+        # Guards only the queue, so write() never waits on the database
+        self.lock = threading.Lock()
+        self.queued = []  # (start, blocks from start up) per write, oldest first
+        self.pending = 0  # Blocks queued since the last flush
+        # The connection is used from the flush thread and at startup and
+        # shutdown, always under db_lock
+        self.db_lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS blocks (height INTEGER PRIMARY KEY, block TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.conn.commit()
+        self.checkpoint = self.get_meta("checkpoint", -1)
+        self.tip_height = self.conn.execute("SELECT MAX(height) FROM blocks").fetchone()[0]
+        self.tip_height = -1 if self.tip_height is None else self.tip_height
+        self.last_commit = time.time()
+
+    def get_meta(self, key, default):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def load(self):
+        """
+        Read the stored chain.
+
+        Returns:
+            (chain, checkpoint): the blocks from height 0 up to the first
+            gap, and the height up to which they are known to be verified.
+        """
+        with self.db_lock:
+            rows = self.conn.execute("SELECT height, block FROM blocks ORDER BY height").fetchall()
+        length = 0
+        while length < len(rows) and rows[length][0] == length:
+            length += 1
+        # One parse of a JSON array is far cheaper than a json.loads per block
+        chain = [Block.from_wire(block) for block in json.loads("[" + ",".join(block for _, block in rows[:length]) + "]")]
+        return chain, min(self.checkpoint, len(chain) - 1)
+
+    def write(self, chain, start):
+        """
+        Make the store hold `chain`, rewriting it from height `start` up.
+
+        Heights below `start` must already be stored as they are in `chain`.
+        Anything stored above the new tip (a chain we reorganised away from)
+        is deleted. Nothing reaches the database until the next flush.
+        """
+        blocks = chain[start:]
+        with self.lock:
+            self.queued.append((start, blocks))
+            self.pending += len(blocks)
+
+    def flush(self):
+        """Write out and commit any queued blocks now."""
+        # Held from taking the queue to the commit, so flushes apply writes in order
+        with self.db_lock:
+            with self.lock:
+                queued, self.queued, self.pending = self.queued, [], 0
+            if not queued:
+                return
+            for start, blocks in queued:
+                self.conn.execute("DELETE FROM blocks WHERE height >= ?", (start,))
+                self.conn.executemany(
+                    "INSERT INTO blocks (height, block) VALUES (?, ?)",
+                    ((start + offset, json.dumps(block.to_wire())) for offset, block in enumerate(blocks))
+                )
+                if start <= self.checkpoint:
+                    self.checkpoint = start - 1
+                    self.set_meta("checkpoint", self.checkpoint)
+                self.tip_height = start + len(blocks) - 1
+            self._commit()
+
+    def flush_if_due(self):
+        """Commit queued blocks once SYNC_BATCH are waiting or SYNC_INTERVAL seconds have passed."""
+        if self.queued and (self.pending >= self.SYNC_BATCH or time.time() - self.last_commit >= self.SYNC_INTERVAL):
+            self.flush()
+
+    def _commit(self):
+        # Blocks in this commit were verified before they were written, so
+        # the checkpoint can move up with them; it trails so a few are rechecked.
+        if self.tip_height - self.checkpoint >= 2 * self.CHECKPOINT_BLOCKS:
+            self.checkpoint = self.tip_height - self.CHECKPOINT_BLOCKS
+            self.set_meta("checkpoint", self.checkpoint)
+        self.conn.commit()
+        self.last_commit = time.time()
+
+    def close(self):
+        self.flush()
+        with self.db_lock:
+            self.conn.close()
@@ -0,0 +1,76 @@
+import multiprocessing
+from BlockHash import block_digest, difficulty_target, meets_difficulty
+
+PARALLEL_THRESHOLD = 5000  # Shorter runs are checked in-process; starting a pool costs more than it saves
+CHUNK_SIZE = 2000  # Blocks per task handed to a worker
+
+_chain = None  # The chain being checked, inherited by each worker through init_worker
+
+
+def check_block(chain, height, zero_suffix, nibble_index):
+    """
+    Check one block on its own: its height, proof of work, and that its
+    stored hash is what its fields and its predecessor's stored hash give.
+
+    Every block's hash is checked this way, so a block whose stored hash is
+    consistent also links correctly to the next one.
+    """
+    block = chain[height]
+    if block.height != height:
+        return False
+    prev_hash = chain[height - 1].hash if height > 0 else None
+    digest = block_digest(prev_hash, block)
+    return meets_difficulty(digest, zero_suffix, nibble_index) and digest == block.hash
+
+
+def first_invalid_in_range(chain, start, end, difficulty):
+    """Return the first height in start..end-1 that fails check_block, or None."""
+    zero_suffix, nibble_index = difficulty_target(difficulty)
+    for height in range(start, end):
+        if not check_block(chain, height, zero_suffix, nibble_index):
+            return height
+    return None
+
+
+def init_worker(chain):
+    global _chain
+    _chain = chain
+
+
+def check_chunk(task):
+    start, end, difficulty = task
+    return first_invalid_in_range(_chain, start, end, difficulty)
+
+
+def first_invalid_block(chain, start, difficulty, processes=None):
+    """
+    Find the lowest invalid height in chain[start:], checking chunks in parallel.
+
+    Each block only depends on its own fields and its predecessor's stored
+    hash, so chunks are independent. Workers get the chain when they are
+    forked rather than having it pickled per task, and results are read in
+    chunk order so the first failure reported is the lowest one.
+
+    Args:
+        chain: List of blocks, indexed by height.
+        start: First height to check; must be at least 1 (the genesis block
+            is compared, not hashed).
+        difficulty: Trailing zero hex digits every hash needs.
+        processes: Worker processes (default: one per core). 1 checks
+            in-process.
+
+    Returns:
+        The first invalid height, or None if every block checked out.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1 or len(chain) - start < PARALLEL_THRESHOLD:
+        return first_invalid_in_range(chain, start, len(chain), difficulty)
+
+    tasks = [(first, min(first + CHUNK_SIZE, len(chain)), difficulty)
+             for first in range(start, len(chain), CHUNK_SIZE)]
+    # Leaving the with block terminates the workers, so a failure stops the rest early
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(chain,)) as pool:
+        for failed in pool.imap(check_chunk, tasks):
+            if failed is not None:
+                return failed
+    return None
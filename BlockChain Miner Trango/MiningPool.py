@@ -0,0 +1,262 @@
+import multiprocessing
+import os
+import queue
+import time
+
+from Blockchain import Blockchain
+from BlockHash import difficulty_target, hash_prefix
+
+
+# Nonces hashed between checks of the shared generation word
+CANCEL_CHECK_INTERVAL = 1000
+# Seconds before a worker rolls its template onto a fresh timestamp
+TIMESTAMP_REFRESH_INTERVAL = 30
+
+
+# Define the mining function outside the class to make it picklable
+def mine_nonce_range(prev_hash, block_data, start_nonce, end_nonce, difficulty,
+                     generation=None, current_generation=None, hash_counts=None, worker_index=0,
+                     nonce_prefix=''):
+    """
+    Function to mine a nonce range.
+
+    The invariant part of the block (previous hash, minedBy, messages and
+    timestamp, plus `nonce_prefix`) is hashed once; every candidate nonce
+    only copies that midstate and feeds it the counter digits, which are
+    written in place into a preallocated buffer. The difficulty is tested on the raw digest;
+    hex is only built for the winning hash.
+
+    If `generation` is given, it is read every CANCEL_CHECK_INTERVAL nonces
+    and the search is abandoned once it no longer equals `current_generation`.
+    If `hash_counts` is given, `hash_counts[worker_index]` is advanced by the
+    number of nonces hashed at every such check and on return.
+
+    Returns:
+        (nonce, hash) for the first nonce meeting the difficulty, or None.
+        The nonce is the full string: `nonce_prefix` followed by the counter.
+    """
+    pid = os.getpid()
+    zero_suffix, nibble_index = difficulty_target(difficulty)
+    midstate = hash_prefix(prev_hash, block_data['mined_by'], block_data['messages'], block_data['timestamp'])
+    midstate.update(nonce_prefix.encode())
+    nonce_buf = bytearray(Blockchain.MAX_NONCE_LENGTH)
+
+    nonce = start_nonce
+    counted = start_nonce  # Nonces below this are already in hash_counts
+    next_check = start_nonce + CANCEL_CHECK_INTERVAL
+    while nonce < end_nonce:
+        if nonce >= next_check:
+            if hash_counts is not None:
+                hash_counts[worker_index] += nonce - counted
+                counted = nonce
+            # Plain shared-memory read; no lock and no IPC round trip
+            if generation is not None and generation.value != current_generation:
+                return None
+            next_check = nonce + CANCEL_CHECK_INTERVAL
+        # The leading digits only change once every ten nonces
+        leading = str(nonce // 10).encode() if nonce >= 10 else b''
+        last = len(leading)
+        nonce_buf[:last] = leading
+        nonce_view = memoryview(nonce_buf)[:last + 1]
+        for digit in range(nonce % 10, min(10, nonce % 10 + end_nonce - nonce)):
+            nonce_buf[last] = 48 + digit  # ASCII '0' + digit
+            candidate = midstate.copy()
+            candidate.update(nonce_view)
+            digest = candidate.digest()
+            if digest.endswith(zero_suffix) and (nibble_index is None or not digest[nibble_index] & 0x0F):
+                if hash_counts is not None:
+                    hash_counts[worker_index] += nonce + 1 - counted
+                nonce = nonce_prefix + str(nonce)
+                print(f"Process {pid} found nonce: {nonce}, Hash: {digest.hex()}")
+                return nonce, digest
+            nonce += 1
+    if hash_counts is not None:
+        hash_counts[worker_index] += nonce - counted
+    return None
+
+
+def block_template(block):
+    """The fields of a Block the kernels hash before the nonce, as a dict workers can roll."""
+    return {
+        'messages': block.messages,
+        'mined_by': block.mined_by,
+        'timestamp': block.timestamp
+    }
+
+
+def worker_nonce_tag(node_index, worker_index):
+    """
+    Build the fixed start of every nonce a worker tries.
+
+    Nonces look like "<node>.<worker>.<random>.<extra nonce>.<counter>".
+    The node and worker indexes keep machines and processes sharing a miner
+    name apart, and the random part keeps a restarted worker from repeating
+    its earlier work. The counter is the only part without a dot, so
+    distinct prefixes always give distinct nonces.
+    """
+    return f"{node_index}.{worker_index}.{os.urandom(4).hex()}."
+
+
+def extra_nonce_prefix(tag, extra_nonce):
+    """The nonce prefix a worker hashes into its midstate for one extra nonce."""
+    return f"{tag}{extra_nonce:x}."
+
+
+def mining_worker(worker_index, template_conn, generation, hash_counts, result_queue,
+                  difficulty, chunk_size, node_index):
+    """
+    Long-lived worker loop.
+
+    Each template arrives over `template_conn` tagged with the generation it
+    belongs to. The worker searches its own nonce space, so it never has to
+    coordinate ranges with other workers: after every `chunk_size` counter
+    values it bumps its extra nonce, and every TIMESTAMP_REFRESH_INTERVAL it
+    moves the template onto the current time. Either way, only the midstate
+    has to be rebuilt. When the shared generation moves on, the worker
+    abandons the chunk in hand within CANCEL_CHECK_INTERVAL nonces and picks
+    up the newest template. A template of None means "stay idle"; a
+    generation of None means "exit". Hashes done are added to
+    `hash_counts[worker_index]`, which only this worker writes.
+    """
+    counter_digits = len(str(chunk_size - 1))
+    tag = worker_nonce_tag(node_index, worker_index)
+    extra_nonce = 0  # Never reset, so a re-sent template is not searched twice
+    current_generation, template = 0, None
+    while True:
+        if template is None or generation.value != current_generation:
+            # Block for the next template, then skip to the newest one queued
+            current_generation, template = template_conn.recv()
+            while template_conn.poll():
+                current_generation, template = template_conn.recv()
+            if current_generation is None:
+                return
+            if template is not None:
+                prev_hash, block_data = template
+                block_data = dict(block_data)  # Timestamp is rolled locally
+            continue
+
+        now = int(time.time())
+        if now - block_data['timestamp'] >= TIMESTAMP_REFRESH_INTERVAL:
+            block_data['timestamp'] = now
+        nonce_prefix = extra_nonce_prefix(tag, extra_nonce)
+        if len(nonce_prefix) + counter_digits > Blockchain.MAX_NONCE_LENGTH:
+            # Out of extra nonces (practically never); start a new random tag
+            tag, extra_nonce = worker_nonce_tag(node_index, worker_index), 0
+            continue
+        extra_nonce += 1
+
+        found = mine_nonce_range(
+            prev_hash, block_data, 0, chunk_size, difficulty,
+            generation, current_generation, hash_counts, worker_index, nonce_prefix
+        )
+        if found:
+            nonce, block_hash = found
+            result_queue.put((current_generation, nonce, block_data['timestamp'], block_hash))
+            # Nothing left to do for this template until a new one arrives
+            template = None
+
+
+class MiningPool:
+    NONCES_PER_CHUNK = 100000  # Counter values per extra nonce, before the midstate rolls
+
+    def __init__(self, difficulty, num_workers=None, node_index=0):
+        """
+        Initialize the MiningPool.
+
+        Args:
+            difficulty: Number of trailing zero hex digits a block hash needs.
+            num_workers: Worker processes to run; defaults to one per CPU.
+            node_index: This machine's index among machines mining under the same name;
+                it is part of every nonce, so the machines never search the same space.
+        """
+        if node_index < 0:
+            raise ValueError(f"Node index {node_index} is negative")
+        self.difficulty = difficulty
+        self.node_index = node_index
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        # Bumped for every new template or cancellation. Workers poll it as
+        # their cancellation signal, so it is a lock-free shared word;
+        # writers serialize on generation_lock instead.
+        self.generation = multiprocessing.RawValue('q', 0)
+        self.generation_lock = multiprocessing.Lock()
+        # Nonces hashed by each worker; one writer per slot, so no lock
+        self.hash_counts = multiprocessing.RawArray('q', self.num_workers)
+        self.template_start_hashes = 0  # total_hashes() when the last template was set
+        self.result_queue = multiprocessing.Queue()
+        self.template_conns = []
+        self.workers = []
+
+    def start(self):
+        """Start the worker processes; they stay idle until a template is set."""
+        for worker_index in range(self.num_workers):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=mining_worker,
+                args=(worker_index, child_conn, self.generation, self.hash_counts, self.result_queue,
+                      self.difficulty, self.NONCES_PER_CHUNK, self.node_index),
+                daemon=True
+            )
+            worker.start()
+            self.template_conns.append(parent_conn)
+            self.workers.append(worker)
+        print(f"Mining pool started with {self.num_workers} workers (node index {self.node_index}).")
+
+    def _publish(self, template):
+        """Move every worker onto a new generation with the given template."""
+        # Held across the sends too: the miner thread and tip listeners both publish
+        with self.generation_lock:
+            self.generation.value += 1
+            current_generation = self.generation.value
+            for conn in self.template_conns:
+                conn.send((current_generation, template))
+        return current_generation
+
+    def set_template(self, prev_hash, block):
+        """Start mining `block` on top of `prev_hash`, replacing any current work."""
+        block_data = block_template(block)
+        self.template_start_hashes = self.total_hashes()
+        return self._publish((prev_hash, block_data))
+
+    def cancel(self):
+        """Stop hashing immediately and leave the workers waiting for the next template."""
+        self._publish(None)
+
+    def total_hashes(self):
+        """Nonces hashed by all workers since the pool started."""
+        return sum(self.hash_counts)
+
+    def hashes_since_template(self):
+        """Nonces hashed since the last template was set, including after a cancel()."""
+        return self.total_hashes() - self.template_start_hashes
+
+    def get_result(self, timeout):
+        """
+        Wait up to `timeout` seconds for a result of the current template.
+
+        Returns:
+            (nonce, timestamp, hash) or None. The timestamp may be newer than
+            the template's. Results for superseded templates are dropped.
+        """
+        try:
+            result_generation, nonce, timestamp, block_hash = self.result_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if result_generation != self.generation.value:
+            return None
+        return nonce, timestamp, block_hash
+
+    def stop(self):
+        """Tell every worker to exit and wait for them."""
+        with self.generation_lock:
+            self.generation.value += 1  # Abandon any chunk in hand
+        for conn in self.template_conns:
+            try:
+                conn.send((None, None))
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        self.template_conns = []
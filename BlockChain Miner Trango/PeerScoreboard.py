@@ -0,0 +1,173 @@
+from collections import OrderedDict
+
+
+class PeerScoreboard:
+    """
+    Per-peer latency, loss and bad-block statistics, kept as EWMAs.
+
+    A Peer keeps one scoreboard for its whole life, so what one consensus
+    run learns about slow, lossy or lying peers carries over to the next.
+    Peers are keyed by (host, port) as they appear in the peer lists. At
+    most MAX_PEERS are scored at once; past that, the peer recorded least
+    recently is forgotten.
+    """
+    ALPHA = 0.2  # Weight of a new observation in the loss and bad-block EWMAs
+    INITIAL_RTO = 1.0  # Retransmission timeout (seconds) before a peer has any RTT samples
+    MIN_RTO = 0.05
+    MAX_RTO = 5.0
+    MAX_BACKOFF = 8  # Cap on the timeout multiplier for a peer that keeps losing requests
+    BACKOFF_LOSS = 0.5  # Above this loss rate a peer only gets one probe request at a time
+    BAD_BLOCK_PENALTY = 20  # A peer serving only bad blocks looks this many times slower
+    DISTRUST_BAD_BLOCKS = 0.5  # Above this bad-block rate a peer's chain is only used if nobody else has one
+    BATCH_PROBES = 2  # Unanswered GET_BLOCKS requests before a peer is taken to only speak GET_BLOCK
+    MAX_PEERS = 256  # Peers scored at once
+
+    def __init__(self):
+        self.rtt = {}  # peer -> (smoothed RTT, RTT variance)
+        self.backoff = {}  # peer -> timeout multiplier since its last reply
+        self.loss = {}  # peer -> EWMA of "this request was lost"
+        self.bad_blocks = {}  # peer -> EWMA of "this block failed validation"
+        self.batching = {}  # peer -> whether it answers GET_BLOCKS, once known
+        self.batch_misses = {}  # peer -> GET_BLOCKS requests lost before it ever answered one
+        self.recent = OrderedDict()  # Every scored peer, least recently recorded first
+
+    def _ewma(self, table, peer, observation):
+        table[peer] = (1 - self.ALPHA) * table.get(peer, 0.0) + self.ALPHA * observation
+
+    def _touch(self, peer):
+        """Mark `peer` as just recorded, forgetting the stalest peers past MAX_PEERS."""
+        self.recent[peer] = None
+        self.recent.move_to_end(peer)
+        while len(self.recent) > self.MAX_PEERS:
+            self.forget(next(iter(self.recent)))
+
+    def forget(self, peer):
+        """Drop everything recorded about `peer`, e.g. once it is no longer tracked."""
+        self.recent.pop(peer, None)
+        for table in (self.rtt, self.backoff, self.loss, self.bad_blocks, self.batching, self.batch_misses):
+            table.pop(peer, None)
+
+    def record_reply(self, peer, rtt=None):
+        """
+        Record that a request to `peer` was answered.
+
+        Args:
+            rtt: Round trip time in seconds, or None if the request was
+                retransmitted and so cannot be timed (Karn's rule).
+        """
+        self._touch(peer)
+        self.backoff[peer] = 1
+        self._ewma(self.loss, peer, 0)
+        if rtt is None:
+            return
+        if peer not in self.rtt:
+            self.rtt[peer] = (rtt, rtt / 2)
+        else:
+            srtt, rttvar = self.rtt[peer]
+            rttvar = 0.75 * rttvar + 0.25 * abs(srtt - rtt)
+            srtt = 0.875 * srtt + 0.125 * rtt
+            self.rtt[peer] = (srtt, rttvar)
+
+    def record_loss(self, peer):
+        """Record a request to `peer` that timed out, doubling its timeout."""
+        self._touch(peer)
+        self.backoff[peer] = min(self.backoff.get(peer, 1) * 2, self.MAX_BACKOFF)
+        self._ewma(self.loss, peer, 1)
+
+    def record_block(self, peer, valid):
+        """Record whether the blocks `peer` served in one sync passed validation."""
+        self._touch(peer)
+        self._ewma(self.bad_blocks, peer, 0 if valid else 1)
+
+    def record_false_tip(self, peer):
+        """Record that `peer` lacks blocks below the tip it claimed in STATS, distrusting it outright."""
+        self._touch(peer)
+        self.bad_blocks[peer] = 1.0
+
+    def record_batch_reply(self, peer):
+        """Record that `peer` answered a GET_BLOCKS request."""
+        self._touch(peer)
+        self.batching[peer] = True
+
+    def record_batch_loss(self, peer):
+        """Record a GET_BLOCKS request to `peer` that timed out."""
+        self._touch(peer)
+        if peer in self.batching:
+            return
+        self.batch_misses[peer] = self.batch_misses.get(peer, 0) + 1
+        if self.batch_misses[peer] >= self.BATCH_PROBES:
+            print(f"{peer[0]}:{peer[1]} does not answer GET_BLOCKS. Falling back to GET_BLOCK.")
+            self.batching[peer] = False
+
+    def supports_batch(self, peer):
+        """True or False once `peer` has shown whether it answers GET_BLOCKS, None until then."""
+        return self.batching.get(peer)
+
+    def rto(self, peer):
+        """Retransmission timeout for a peer, from its RTT estimate as in TCP (RFC 6298)."""
+        if peer in self.rtt:
+            srtt, rttvar = self.rtt[peer]
+            base = max(self.MIN_RTO, srtt + 4 * rttvar)
+        else:
+            base = self.INITIAL_RTO
+        return min(self.MAX_RTO, base * self.backoff.get(peer, 1))
+
+    def cost(self, peer):
+        """
+        Expected seconds to get one good block from `peer`.
+
+        The RTT is inflated by the expected number of sends per reply and by
+        how often the peer's blocks turn out to be bad. Peers without an RTT
+        sample are costed at the best known RTT, so they still get tried.
+        """
+        if peer in self.rtt:
+            srtt = self.rtt[peer][0]
+        else:
+            # Copied first: the event loop may forget peers while consensus runs
+            srtt = min((srtt for srtt, _ in list(self.rtt.values())), default=self.INITIAL_RTO)
+        loss = min(self.loss.get(peer, 0.0), 0.99)
+        return max(srtt, 1e-4) / (1 - loss) * (1 + self.BAD_BLOCK_PENALTY * self.bad_blocks.get(peer, 0.0))
+
+    def backed_off(self, peer):
+        """Whether `peer` has been losing most of its requests lately."""
+        return self.loss.get(peer, 0.0) > self.BACKOFF_LOSS
+
+    def distrusted(self, peer):
+        """Whether `peer` has recently served chains that failed validation."""
+        return self.bad_blocks.get(peer, 0.0) > self.DISTRUST_BAD_BLOCKS
+
+    def choose(self, peers, load):
+        """
+        Pick the peer that should finish one more request soonest.
+
+        Each peer is charged cost * (requests it already has + 1), so fast
+        peers take a larger share of the window. While any healthy peer is
+        available, backed-off peers are limited to a single outstanding probe.
+
+        Args:
+            peers: Candidate peers.
+            load: Peer -> number of requests currently in flight to it.
+        """
+        if not peers:
+            return None
+        usable = [p for p in peers if not (self.backed_off(p) and load.get(p, 0) >= 1)]
+        if not any(not self.backed_off(p) for p in usable):
+            usable = peers
+        return min(usable, key=lambda p: self.cost(p) * (load.get(p, 0) + 1))
+
+    def summary(self):
+        """
+        Fixed-size aggregates for logging and METRICS.
+
+        Per-peer scores are left out, so the reply stays the same size however
+        many peers are scored.
+        """
+        peers = list(self.recent)
+        rtts = sorted(srtt for srtt, _ in list(self.rtt.values()))
+        return {
+            "peers": len(peers),
+            "backed_off": sum(1 for peer in peers if self.backed_off(peer)),
+            "distrusted": sum(1 for peer in peers if self.distrusted(peer)),
+            "best_rtt": round(rtts[0], 4) if rtts else None,
+            "median_rtt": round(rtts[len(rtts) // 2], 4) if rtts else None,
+        }
@@ -1,41 +1,63 @@
+import asyncio
+import hmac
 import socket
 import json
+import random
+import secrets
 import threading
 import time
 import uuid
-import hashlib
-import multiprocessing
-import os
 from BlockchainFetcher import BlockchainFetcher
+from Block import Block
 from Blockchain import Blockchain
+import BlockTree
+from ChainStore import ChainStore
+from MiningPool import MiningPool
+from PeerScoreboard import PeerScoreboard
+from SeenCache import SeenCache
 
 
-# Define the mining function outside the class to make it picklable
-def mine_nonce_range(block_data, start_nonce, end_nonce, difficulty, result_queue):
-    """Function to mine a nonce range."""
-    pid = os.getpid()
-    target = '0' * difficulty
+class PeerProtocol(asyncio.DatagramProtocol):
+    """Hands every datagram on a Peer's socket to the Peer, on its event loop."""
 
-    for nonce in range(start_nonce, end_nonce):
-        # Check if a result has already been found
-        if not result_queue.empty():
-            return
-        block_data['nonce'] = str(nonce)
-        block_hash = hashlib.sha256(json.dumps(block_data, sort_keys=True).encode()).hexdigest()
-        if block_hash.endswith(target):
-            # Put the result in the queue
-            result_queue.put((nonce, block_hash))
-            print(f"Process {pid} found nonce: {nonce}, Hash: {block_hash}")
-            return
-        if nonce % 100000 == 0:
-            print(f"Process {pid} still mining... Current nonce: {nonce}")
+    def __init__(self, peer):
+        self.peer = peer
 
+    def datagram_received(self, data, addr):
+        self.peer.handle_datagram(data, addr)
 
-class Peer:
-    GOSSIP_INTERVAL = 30  # Re-GOSSIP every 30 seconds
-    MAX_PEERS_TO_GOSSIP = 3  # Repeat GOSSIP to 3 tracked peers
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable after replying to a peer that went away
+        print(f"Socket error: {exc}")
 
-    def __init__(self, host, port):
+
+class Peer:
+    GOSSIP_INTERVAL = 30  # Re-GOSSIP every 30 seconds, give or take GOSSIP_JITTER
+    GOSSIP_JITTER = 0.2  # Each wait is a random 80-120% of GOSSIP_INTERVAL, so peers drift out of lockstep
+    MAX_PEERS_TO_GOSSIP = 5  # Random peers each GOSSIP is sent and forwarded to; misses about e**-5 of peers
+    PEER_TIMEOUT = 3 * GOSSIP_INTERVAL  # Tracked peers silent this long are dropped
+    GOSSIP_SEEN_TTL = 10 * GOSSIP_INTERVAL  # Seconds a GOSSIP ID is remembered for
+    MAX_GOSSIP_SEEN = 10000  # Most GOSSIP IDs remembered at once
+    MINING_POLL_INTERVAL = 0.01  # Seconds between checks for a result or a new tip
+    METRICS_INTERVAL = 10  # Sample hash rates and log a metrics line every 10 seconds
+    STORE_FLUSH_INTERVAL = 1  # Seconds between checks for chain store writes waiting on a commit
+    MAX_BATCH_BLOCKS = 64  # Most blocks sent back for one GET_BLOCKS request
+    MAX_DATAGRAM = 1400  # Bytes per GET_BLOCKS_REPLY datagram, so it fits one Ethernet frame unfragmented
+    REPLY_CACHE_SIZE = 10000  # Encoded GET_BLOCK replies kept; 0 turns the cache off
+    STATS_DEADLINE = 2  # Seconds consensus waits for STATS replies, shared by every peer asked
+    STATS_GRACE = 0.5  # Seconds slower peers get once the first STATS reply is in
+    AHEAD_CONSENSUS_INTERVAL = 30  # Least seconds between consensus runs started by blocks announced far ahead
+    MISSING_BLOCK_REPLY = json.dumps({
+        "type": "GET_BLOCK_REPLY",
+        "height": None,
+        "messages": None,
+        "minedBy": None,
+        "nonce": None,
+        "hash": None,
+        "timestamp": None
+    }).encode()
+
+    def __init__(self, host, port, node_index=0, store_path=None):
         self.host = host
         self.port = port
         self.well_known_peers = [
@@ -44,14 +66,54 @@ class Peer:
             ("hawk.cs.umanitoba.ca", 8999),
         ]
         self.tracked_peers = set()  # Dynamically track peers
+        self.peer_last_seen = {}  # Tracked peer -> when it last sent GOSSIP or GOSSIP_REPLY
+        self.peers_evicted = 0
+        self.gossip_sent = 0  # GOSSIP datagrams for our own rounds
+        self.gossip_forwarded = 0  # GOSSIP datagrams passed on for other peers
+        self.fetch_peers = BlockchainFetcher.FETCH_PEERS  # Peers blocks are fetched from, or None for all known peers
         self.blockchain = Blockchain()  # Initialize the blockchain
+        self.chain_store = None
+        if store_path:
+            # Pick up where the last run left off instead of resyncing from genesis
+            self.chain_store = ChainStore(store_path)
+            self.blockchain.attach_store(self.chain_store)
+        self.block_tree = BlockTree.BlockTree(self.blockchain)  # Competing branches, so forks resolve without a refetch
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock.bind((self.host, self.port))
         self.running = True
-        self.gossip_seen = set()  # Keep track of seen GOSSIP IDs
+        # Set up by serve(); handlers run on this loop and must not block it
+        self.loop = None
+        self.transport = None
+        self.stopped = asyncio.Event()
+        self.consensus_task = None
+        self.last_ahead_consensus = 0.0  # When a block announced far ahead last started a consensus
+        # Encoded replies, each kept with the block it was built from and
+        # reused while that block is still in place
+        self.block_replies = {}  # height -> (block, GET_BLOCK_REPLY bytes)
+        self.stats_reply = (None, None)  # (tip, STATS_REPLY bytes)
+        self.token_key = secrets.token_bytes(16)  # Signs the GET_BLOCKS tokens handed to requesters
+        self.gossip_seen = SeenCache(self.GOSSIP_SEEN_TTL, self.MAX_GOSSIP_SEEN)  # Recently seen GOSSIP IDs
+        self.scoreboard = PeerScoreboard()  # Latency, loss and bad-block scores, kept across consensus runs
 
         self.name = "Nico Rosberg"
         self.mining_enabled = True  # Flag to control mining
+        # Lives as long as the peer
+        self.mining_pool = MiningPool(
+            self.blockchain.DIFFICULTY, node_index=node_index
+        )
+        self.tip_changed = threading.Event()  # Set when the chain tip moves under the miner
+        self.stale_nonces = 0  # Nonces hashed on templates that were thrown away
+        self.blockchain.add_tip_listener(self.on_tip_change)
+
+        # Mining metrics, served by METRICS and logged by periodic_metrics
+        self.blocks_mined = 0
+        self.last_time_to_block = None
+        self.total_time_to_block = 0.0
+        self.consensus_runs = 0
+        self.last_consensus_pause = None
+        self.total_consensus_pause = 0.0
+        self.worker_hash_rates = [0.0] * self.mining_pool.num_workers
+        self.last_hash_sample = (time.time(), list(self.mining_pool.hash_counts))
 
     # -------------------- Mining Methods --------------------
 
@@ -63,127 +125,110 @@ class Peer:
             if len(msg) > self.blockchain.MAX_MESSAGE_LENGTH:
                 raise ValueError("Message exceeds maximum length of 20 characters.")
 
-        new_block = {
-            'type': 'GET_BLOCK_REPLY',
-            'height': len(self.blockchain.chain),
-            'messages': messages,
-            'minedBy': miner_name,
-            'nonce': '',  # To be determined during mining
-            'timestamp': int(time.time()),
-            'hash': ''  # To be determined during mining
-        }
+        new_block = Block(
+            height=self.blockchain.tip_height + 1,
+            mined_by=miner_name,
+            messages=messages,
+            nonce='',  # To be determined during mining
+            timestamp=int(time.time()),
+        )
         return new_block
 
-    def mine_block(self, block):
-        """Mine the block to meet the difficulty requirement using multi-processing."""
-        print(f"Mining block with height {block['height']} using multi-processing...")
-        difficulty = self.blockchain.DIFFICULTY
-
-        manager = multiprocessing.Manager()
-        result_queue = manager.Queue()
-        num_processes = multiprocessing.cpu_count()
-        nonce_range_per_process = 1000000  # Adjust as needed
-
-        # Prepare block data without the nonce and hash
-        block_data = {
-            'type': block['type'],
-            'height': block['height'],
-            'messages': block['messages'],
-            'minedBy': block['minedBy'],
-            'timestamp': block['timestamp']
-        }
+    def on_tip_change(self, tip):
+        """Blockchain tip listener: stop hashing the old template right away."""
+        self.tip_changed.set()
+        self.mining_pool.cancel()
 
-        processes = []
-        start_nonce = 0
-        found = False
-
-        while not found and self.running and self.mining_enabled:
-            processes = []  # Reset processes list each iteration
-            for i in range(num_processes):
-                process_start_nonce = start_nonce + i * nonce_range_per_process
-                process_end_nonce = process_start_nonce + nonce_range_per_process
-                p = multiprocessing.Process(
-                    target=mine_nonce_range,
-                    args=(block_data.copy(), process_start_nonce, process_end_nonce, difficulty, result_queue)
-                )
-                processes.append(p)
-                p.start()
-
-            # Wait for a result or processes to finish
-            nonce_found = False
-            while self.running and self.mining_enabled:
-                if not result_queue.empty():
-                    nonce, block_hash = result_queue.get()
-                    nonce_found = True
-                    found = True
-                    break
-                if all(not p.is_alive() for p in processes):
-                    break
-                time.sleep(0.1)
-
-            # Terminate all processes
-            for p in processes:
-                p.terminate()
-                p.join()
-
-            if nonce_found:
-                # Set the nonce and hash
-                block['nonce'] = str(nonce)
-                block['hash'] = block_hash
-                print(f"Block mined! Nonce: {block['nonce']}, Hash: {block['hash']}")
+    def mine_block(self, block):
+        """Mine the block to meet the difficulty requirement using the worker pool."""
+        print(f"Mining block with height {block.height} using {self.mining_pool.num_workers} workers...")
+        prev_hash = self.blockchain.chain[block.height - 1].hash
+        mining_started = time.time()
+        self.mining_pool.set_template(prev_hash, block)
+
+        while self.running and self.mining_enabled and not self.tip_changed.is_set():
+            result = self.mining_pool.get_result(timeout=self.MINING_POLL_INTERVAL)
+            if result:
+                # Workers roll the timestamp on long searches, so take theirs
+                block.nonce, block.timestamp, block.hash = result
+                self.blocks_mined += 1
+                self.last_time_to_block = time.time() - mining_started
+                self.total_time_to_block += self.last_time_to_block
+                print(f"Block mined in {self.last_time_to_block:.1f}s! Nonce: {block.nonce}, Hash: {block.hash_hex}")
                 return block
-            else:
-                if self.mining_enabled:
-                    print(f"Still mining... Checked nonces up to {start_nonce + num_processes * nonce_range_per_process}")
-                start_nonce += num_processes * nonce_range_per_process
 
+        # The template is stale or mining was paused; its work is wasted
+        stale = self.mining_pool.hashes_since_template()
+        self.mining_pool.cancel()
+        self.stale_nonces += stale
+        print(f"Abandoned block at height {block.height} after {stale} nonces ({self.stale_nonces} stale in total).")
         return None
 
     def add_block(self, block):
         """Add a mined block to the blockchain."""
-        if self.blockchain.is_valid_block(block, self.blockchain.chain[-1]):
-            self.blockchain.chain.append(block)
-            print(f"Block added to the blockchain! Height: {block['height']}, Hash: {block['hash']}")
+        outcome = self.block_tree.add_block(block)
+        if outcome in (BlockTree.EXTENDED, BlockTree.REORG):
+            print(f"Block added to the blockchain! Height: {block.height}, Hash: {block.hash_hex}")
+            self.announce_block(block)
+        elif outcome == BlockTree.SIDE:
+            # Another block at this height got there first; ours waits on a side branch
+            print(f"Mined block at height {block.height} lost the race and was kept on a side branch.")
             self.announce_block(block)
         else:
-            print("Mined block is invalid and was not added.")
+            print(f"Mined block was not added ({outcome}).")
 
     def announce_block(self, block):
         """Announce the new block to peers."""
-        message = {
-            "type": "ANNOUNCE",
-            "height": block['height'],
-            "minedBy": block['minedBy'],
-            "nonce": block['nonce'],
-            "messages": block['messages'],
-            "hash": block['hash'],
-            "timestamp": block['timestamp']
-        }
+        message = block.to_wire("ANNOUNCE")
         peers_copy = list(self.tracked_peers)  # Prevent modification during iteration
         for peer in peers_copy:
             self.send_message(message, peer)
         print("Block announcement sent to peers.")
 
-    def handle_announce(self, message):
-        """Handle a block announcement from another peer."""
-        block = {
-            "height": message["height"],
-            "minedBy": message["minedBy"],
-            "nonce": message["nonce"],
-            "messages": message["messages"],
-            "hash": message["hash"],
-            "timestamp": message["timestamp"],
-        }
-        if self.blockchain.is_valid_block(block, self.blockchain.chain[-1]):
-            self.blockchain.chain.append(block)
-            print(f"Block announced by {message['minedBy']} added to the blockchain.")
-        else:
-            print(f"Invalid block announced by {message['minedBy']} rejected.")
+    def handle_announce(self, message, addr=None):
+        """
+        Handle a block announcement from another peer.
+
+        For an orphan, the block its buffered ancestors wait on is asked for
+        from the announcer, whose GET_BLOCK_REPLY comes back through here
+        too, so missed announcements are filled in one block at a time. A
+        block too far ahead for that starts a consensus instead, at most
+        once every AHEAD_CONSENSUS_INTERVAL seconds.
+        """
+        try:
+            block = Block.from_wire(message)
+        except ValueError as e:
+            print(f"Malformed block announcement rejected: {e}")
+            return
+        # Tip listeners cancel whatever we were mining at this height
+        outcome = self.block_tree.add_block(block, source=addr)
+        if outcome == BlockTree.EXTENDED:
+            print(f"Block announced by {block.mined_by} added to the blockchain.")
+        elif outcome == BlockTree.REORG:
+            print(f"Block announced by {block.mined_by} completed a longer branch; switched to it.")
+        elif outcome in (BlockTree.SIDE, BlockTree.ORPHAN):
+            print(f"Block announced by {block.mined_by} at height {block.height} kept as a {outcome} block.")
+            if outcome == BlockTree.ORPHAN and addr is not None:
+                self.send_message({"type": "GET_BLOCK", "height": self.block_tree.missing_height(block)}, addr)
+        elif outcome == BlockTree.AHEAD:
+            if time.time() - self.last_ahead_consensus >= self.AHEAD_CONSENSUS_INTERVAL:
+                print(f"Block announced by {block.mined_by} is far ahead of our tip; starting consensus.")
+                self.last_ahead_consensus = time.time()
+                self.start_consensus()
+            else:
+                print(f"Block announced by {block.mined_by} is far ahead of our tip; consensus ran recently.")
+        elif outcome == BlockTree.INVALID:
+            print(f"Invalid block announced by {block.mined_by} rejected.")
 
     # -------------------- Gossip Methods --------------------
 
     def send_gossip(self):
-        """Send a GOSSIP message to well-known peers and tracked peers."""
+        """
+        Send a GOSSIP message to well-known peers and to a random few tracked peers.
+
+        Returns:
+            The ID of the GOSSIP sent.
+        """
         message_id = str(uuid.uuid4())
         gossip_message = {
             "type": "GOSSIP",
@@ -192,23 +237,45 @@ class Peer:
             "id": message_id,
             "name": self.name,
         }
+        self.gossip_seen.add(message_id)  # So our own GOSSIP coming back is not news
 
         # Send GOSSIP to well-known peers
         for peer in self.well_known_peers:
             self.send_message(gossip_message, peer)
 
-        # Forward GOSSIP to tracked peers
-        peers_copy = list(self.tracked_peers)
-        for peer in peers_copy[:self.MAX_PEERS_TO_GOSSIP]:
+        # A fresh sample every round, so every tracked peer hears from us now and then
+        targets = self.gossip_targets(self.tracked_peers.difference(self.well_known_peers))
+        for peer in targets:
             self.send_message(gossip_message, peer)
+        self.gossip_sent += len(self.well_known_peers) + len(targets)
+        return message_id
+
+    def gossip_targets(self, candidates):
+        """Up to MAX_PEERS_TO_GOSSIP of `candidates`, picked at random."""
+        candidates = list(candidates)
+        return random.sample(candidates, min(self.MAX_PEERS_TO_GOSSIP, len(candidates)))
+
+    def forward_gossip(self, message, exclude):
+        """
+        Pass a GOSSIP heard for the first time on to random known peers.
+
+        Every peer forwards each GOSSIP once, so it spreads like an epidemic
+        in O(log n) hops instead of depending on the well-known peers.
+        """
+        candidates = (self.tracked_peers | set(self.well_known_peers)) - exclude
+        targets = self.gossip_targets(candidates)
+        for peer in targets:
+            self.send_message(message, peer)
+        self.gossip_forwarded += len(targets)
 
     def handle_gossip(self, message, addr):
         """Handle incoming GOSSIP messages."""
-        gossip_id = message.get("id")
-        if gossip_id in self.gossip_seen:
+        origin = (message["host"], message["port"])
+        # Even a repeat shows its sender is still up
+        self.mark_alive(origin)
+        if not self.gossip_seen.add(message.get("id")):
             return
-        self.gossip_seen.add(gossip_id)
-        self.tracked_peers.add((message["host"], message["port"]))
+        self.forward_gossip(message, exclude={origin, addr, (self.host, self.port)})
 
         # Reply to the sender with GOSSIP-REPLY
         gossip_reply = {
@@ -219,86 +286,256 @@ class Peer:
         }
         self.send_message(gossip_reply, addr)
 
-    def periodic_gossip(self):
+    def mark_alive(self, peer):
+        """Track `peer`, or keep tracking it, as heard from just now."""
+        if peer == (self.host, self.port):
+            return
+        self.tracked_peers.add(peer)
+        self.peer_last_seen[peer] = time.time()
+
+    def evict_silent_peers(self):
+        """Stop tracking peers that sent no GOSSIP or GOSSIP_REPLY for PEER_TIMEOUT seconds."""
+        cutoff = time.time() - self.PEER_TIMEOUT
+        for peer in [peer for peer, last_seen in self.peer_last_seen.items() if last_seen < cutoff]:
+            del self.peer_last_seen[peer]
+            self.tracked_peers.discard(peer)
+            self.scoreboard.forget(peer)
+            self.peers_evicted += 1
+            print(f"Dropped silent peer {peer[0]}:{peer[1]}.")
+
+    def gossip_delay(self):
+        """Seconds until the next GOSSIP round: GOSSIP_INTERVAL with random jitter."""
+        return self.GOSSIP_INTERVAL * random.uniform(1 - self.GOSSIP_JITTER, 1 + self.GOSSIP_JITTER)
+
+    async def periodic_gossip(self):
         """Periodically send GOSSIP messages."""
         while self.running:
+            self.evict_silent_peers()
             self.send_gossip()
-            time.sleep(self.GOSSIP_INTERVAL)
+            await asyncio.sleep(self.gossip_delay())
+
+    # -------------------- Metrics Methods --------------------
+
+    def sample_hash_rates(self):
+        """Turn the workers' shared hash counters into per-worker hashes/sec."""
+        now, counts = time.time(), list(self.mining_pool.hash_counts)
+        last_time, last_counts = self.last_hash_sample
+        elapsed = now - last_time
+        if elapsed > 0:
+            self.worker_hash_rates = [(count - last) / elapsed for count, last in zip(counts, last_counts)]
+        self.last_hash_sample = (now, counts)
+
+    def get_metrics(self):
+        """Build a METRICS_REPLY from the latest hash rate sample and mining counters."""
+        total_hashes = self.mining_pool.total_hashes()
+        return {
+            "type": "METRICS_REPLY",
+            "height": self.blockchain.tip_height,
+            "worker_hash_rates": [round(rate) for rate in self.worker_hash_rates],
+            "hash_rate": round(sum(self.worker_hash_rates)),
+            "total_hashes": total_hashes,
+            "stale_nonces": self.stale_nonces,
+            "stale_ratio": self.stale_nonces / total_hashes if total_hashes else 0.0,
+            "blocks_mined": self.blocks_mined,
+            "last_time_to_block": self.last_time_to_block,
+            "avg_time_to_block": self.total_time_to_block / self.blocks_mined if self.blocks_mined else None,
+            "consensus_runs": self.consensus_runs,
+            "last_consensus_pause": self.last_consensus_pause,
+            "total_consensus_pause": self.total_consensus_pause,
+            "peer_scores": self.scoreboard.summary(),
+            "block_tree": self.block_tree.summary(),
+            "gossip": {
+                "seen_ids": self.gossip_seen.summary(),
+                "tracked_peers": len(self.tracked_peers),
+                "peers_evicted": self.peers_evicted,
+                "sent": self.gossip_sent,
+                "forwarded": self.gossip_forwarded,
+            },
+        }
+
+    async def periodic_metrics(self):
+        """Periodically sample hash rates and log the metrics as one JSON line."""
+        while self.running:
+            await asyncio.sleep(self.METRICS_INTERVAL)
+            self.sample_hash_rates()
+            print(json.dumps({"timestamp": int(time.time()), **self.get_metrics()}))
+
+    async def periodic_store_flush(self):
+        """Commit chain store writes that have waited long enough for their batch."""
+        while self.running:
+            await asyncio.sleep(self.STORE_FLUSH_INTERVAL)
+            # A commit waits on fsync, so it happens off the loop
+            await asyncio.to_thread(self.chain_store.flush_if_due)
 
     # -------------------- Other Methods --------------------
 
-    def get_peer_stats(self, peer_host, peer_port):
-        """Get blockchain stats from a peer."""
-        message = {"type": "STATS"}
+    def poll_peer_stats(self, peers):
+        """
+        Ask every peer for STATS at once, scoring how quickly each answered.
+
+        All requests go out from one socket and share one deadline, so a dead
+        peer costs no more than a live one. Waiting ends once every peer has
+        answered, STATS_DEADLINE has passed, or STATS_GRACE after the first
+        reply: live peers answer within milliseconds of each other.
+
+        Returns:
+            (peer, tip height) for every usable reply, in the order they arrived.
+        """
+        waiting = {}  # Resolved address -> (host, port) it was listed under
+        for peer_host, peer_port in peers:
+            try:
+                waiting.setdefault((socket.gethostbyname(peer_host), peer_port), (peer_host, peer_port))
+            except OSError as e:
+                print(f"Could not resolve {peer_host}: {e}")
+
+        replies = []
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(5)
-            sock.sendto(json.dumps(message).encode(), (peer_host, peer_port))
-            response, _ = sock.recvfrom(4096)
-            stats = json.loads(response.decode())
-            return stats
-        except socket.timeout:
-            print(f"Timeout fetching stats from {peer_host}:{peer_port}.")
-            return None
-        except Exception as e:
-            print(f"Error fetching stats from {peer_host}:{peer_port}: {e}")
-            return None
+            request = json.dumps({"type": "STATS"}).encode()
+            sent = time.time()
+            for addr in list(waiting):
+                try:
+                    sock.sendto(request, addr)
+                except OSError as e:
+                    print(f"Error fetching stats from {addr[0]}:{addr[1]}: {e}")
+                    del waiting[addr]
+
+            deadline = sent + self.STATS_DEADLINE
+            while waiting and time.time() < deadline:
+                sock.settimeout(deadline - time.time())
+                try:
+                    response, addr = sock.recvfrom(4096)
+                except socket.timeout:
+                    break
+                except OSError:
+                    continue
+                peer = waiting.pop(addr, None)
+                if peer is None:
+                    continue  # Not asked, or already answered
+                self.scoreboard.record_reply(peer, time.time() - sent)
+                try:
+                    peer_height = json.loads(response).get("height")
+                except (ValueError, AttributeError):
+                    continue
+                # A chain always holds at least the genesis block
+                if isinstance(peer_height, int) and not isinstance(peer_height, bool) and peer_height >= 1:
+                    if not replies:
+                        deadline = min(deadline, time.time() + self.STATS_GRACE)
+                    # STATS_REPLY counts blocks, genesis included; consensus compares tip heights
+                    replies.append((peer, peer_height - 1))
         finally:
             sock.close()
 
+        for peer_host, peer_port in waiting.values():
+            print(f"Timeout fetching stats from {peer_host}:{peer_port}.")
+            self.scoreboard.record_loss((peer_host, peer_port))
+        return replies
+
+    def pick_longest_chain_peer(self, replies):
+        """
+        Pick the peer to sync from out of (peer, height) STATS replies.
+
+        The highest chain wins, with ties going to the best scored peer.
+        Peers that recently served invalid chains are only used when no
+        trusted peer answered.
+
+        Returns:
+            (peer, height), or None if there were no replies.
+        """
+        trusted = [(peer, height) for peer, height in replies if not self.scoreboard.distrusted(peer)]
+        candidates = trusted or replies
+        if not candidates:
+            return None
+        return min(candidates, key=lambda reply: (-reply[1], self.scoreboard.cost(reply[0])))
+
+    def start_consensus(self):
+        """
+        Start perform_consensus as a task, unless one is already running.
+
+        Consensus blocks on its own sockets while it fetches and validates,
+        so it runs in a worker thread; the event loop keeps answering
+        STATS and GET_BLOCK the whole time. Call on the event loop.
+
+        Returns:
+            The consensus task.
+        """
+        if self.consensus_task is not None and not self.consensus_task.done():
+            print("Consensus already running.")
+        else:
+            self.consensus_task = asyncio.ensure_future(asyncio.to_thread(self.perform_consensus))
+        return self.consensus_task
+
     def perform_consensus(self):
-        """Perform consensus by fetching blockchain stats from well-known peers."""
-        # Temporarily pause mining while performing consensus
-        self.mining_enabled = False
+        """Perform consensus by fetching blockchain stats from well-known and tracked peers."""
+        pause_started = None
 
         try:
-            longest_chain_stats = None
-            longest_chain_peer = None
-
-            # Fetch stats from all well-known peers
-            for peer_host, peer_port in self.well_known_peers:
-                print(f"Fetching stats from {peer_host}:{peer_port}...")
-                peer_stats = self.get_peer_stats(peer_host, peer_port)
-                if not peer_stats:
-                    continue
-
-                peer_height = peer_stats.get("height")
-                if peer_height is not None:
-                    if not longest_chain_stats or peer_height > longest_chain_stats["height"]:
-                        longest_chain_stats = peer_stats
-                        longest_chain_peer = (peer_host, peer_port)
+            # Poll every peer we know of, well-known and tracked, in one go
+            all_peers = self.well_known_peers + list(self.tracked_peers)
+            print(f"Fetching stats from {len(all_peers)} peers...")
+            replies = self.poll_peer_stats(all_peers)
 
             # Check if a longer chain exists
-            if not longest_chain_stats:
+            longest = self.pick_longest_chain_peer(replies)
+            if not longest:
                 print("Failed to find any valid peers with longer chains. Skipping consensus.")
                 return
+            longest_chain_peer, longest_chain_height = longest
 
             # If our local chain is already as long or longer, no need to fetch
-            if longest_chain_stats["height"] <= len(self.blockchain.chain) - 1:
+            if longest_chain_height <= self.blockchain.tip_height:
                 print("Local blockchain is already up to date or matches the longest chain.")
                 return
 
-            print(f"Peer {longest_chain_peer[0]}:{longest_chain_peer[1]} has the longest chain (height {longest_chain_stats['height']}). Fetching their blockchain...")
-
-            # Clear local chain
-            self.blockchain.chain = []
-
-            # Prepare a list of all peers (well-known + tracked) for workload distribution
-            all_peers = self.well_known_peers + list(self.tracked_peers)
-
-            # Instantiate the fetcher and fetch all blocks
-            fetcher = BlockchainFetcher(self.blockchain)
-            fetcher.fetch_all_blocks(all_peers, longest_chain_peer, longest_chain_stats["height"])
-
-            # Validate the fetched chain
-            if self.blockchain.validate_fetched_chain(self.blockchain.chain):
-                print(f"Consensus complete. Blockchain synchronized with height: {len(self.blockchain.chain) - 1}")
-            else:
-                print("Fetched blockchain is invalid. Keeping local blockchain.")
+            print(f"Peer {longest_chain_peer[0]}:{longest_chain_peer[1]} has the longest chain (height {longest_chain_height}). Fetching their blockchain...")
+
+            # Pause mining only now: blocks mined on a chain we are about to leave are wasted
+            self.mining_enabled = False
+            pause_started = time.time()
+
+            # Fetch into a scratch chain so the local one survives a bad fetch
+            fetched = Blockchain()
+            fetched.DIFFICULTY = self.blockchain.DIFFICULTY  # Validate by our own rules
+            # Peers silent through the STATS poll would only cost the window a timeout each
+            answered = [peer for peer, _ in replies]
+            silent = set(all_peers).difference(answered)
+            fetch_peers = None if self.fetch_peers is None else [peer for peer in self.fetch_peers if peer not in silent]
+            fetcher = BlockchainFetcher(fetched, fetch_peers=fetch_peers, scoreboard=self.scoreboard)
+
+            # Keep the prefix we share with the longest chain and fetch only the rest
+            local_chain = list(self.blockchain.chain)
+            fork_height = fetcher.find_fork_height(longest_chain_peer, local_chain, longest_chain_height)
+            if fork_height == -1:
+                print("Longest chain peer's genesis block does not match ours. Skipping consensus.")
+                self.scoreboard.record_block(longest_chain_peer, False)
+                return
+            if fork_height is None:
+                fork_height = 0  # Everyone shares the hard-coded genesis block
+            fetched.replace_chain(local_chain[:fork_height + 1], start=0)
+            print(f"Chains share blocks 0..{fork_height}. Fetching blocks {fork_height + 1}..{longest_chain_height}...")
+
+            # Blocks are validated as they stream in, so the suffix is checked once it has arrived
+            fetcher.fetch_all_blocks(answered, longest_chain_peer, longest_chain_height, start_height=fork_height + 1)
+
+            with self.block_tree.lock:
+                # Announcements may have moved the tip while we were fetching
+                if fetched.tip_height > self.blockchain.tip_height:
+                    # A branch switch below the fork would have changed this block's hash
+                    shared = (fork_height <= self.blockchain.tip_height
+                              and self.blockchain.chain[fork_height].hash == fetched.chain[fork_height].hash)
+                    # Tip listeners move the miner onto the new tip
+                    self.blockchain.replace_chain(fetched.chain, start=fork_height + 1 if shared else None)
+                    print(f"Consensus complete. Blockchain synchronized with height: {self.blockchain.tip_height}")
+                else:
+                    print("Fetched blockchain is not longer than ours. Keeping local blockchain.")
         finally:
             # Re-enable mining after consensus if still running
             if self.running:
                 self.mining_enabled = True
+            self.consensus_runs += 1
+            self.last_consensus_pause = 0.0 if pause_started is None else time.time() - pause_started
+            self.total_consensus_pause += self.last_consensus_pause
+            print(f"Mining paused {self.last_consensus_pause:.2f}s for consensus.")
 
     def handle_message(self, message, addr):
         """Handle incoming messages based on their type."""
@@ -306,106 +543,237 @@ class Peer:
 
         if msg_type == "STATS":
             # Respond with local blockchain stats
-            response = {
-                "type": "STATS_REPLY",
-                "height": len(self.blockchain.chain),
-                "hash": self.blockchain.chain[-1]["hash"] if self.blockchain.chain else None,
-            }
-            print(f"Sending STATS_REPLY: {response}")
-            self.send_message(response, addr)
+            print(f"Sending STATS_REPLY to {addr[0]}:{addr[1]}")
+            self.send_bytes(self.encoded_stats_reply(), addr)
 
         elif msg_type == "GET_BLOCK":
             # Return a specific block
             height = message.get("height")
-            if height is not None and 0 <= height < len(self.blockchain.chain):
-                block = self.blockchain.chain[height]
-                response = {
-                    "type": "GET_BLOCK_REPLY",
-                    **block
-                }
+            if isinstance(height, int) and 0 <= height < len(self.blockchain.chain):
+                self.send_bytes(self.encoded_block_reply(height), addr)
             else:
-                response = {
-                    "type": "GET_BLOCK_REPLY",
-                    "height": None,
-                    "messages": None,
-                    "minedBy": None,
-                    "nonce": None,
-                    "hash": None,
-                    "timestamp": None
-                }
-            self.send_message(response, addr)
+                self.send_bytes(self.MISSING_BLOCK_REPLY, addr)
+
+        elif msg_type == "GET_BLOCKS":
+            # Return a run of blocks, packed into as few datagrams as fit
+            height, count = message.get("height"), message.get("count")
+            if isinstance(height, int) and isinstance(count, int) and height >= 0 and count > 0:
+                token = self.address_token(addr)
+                if not hmac.compare_digest(str(message.get("token")), token):
+                    # Blocks only go to an address that has shown it receives our
+                    # replies, so a spoofed source cannot turn GET_BLOCKS into a flood
+                    self.send_message({"type": "GET_BLOCKS_REPLY", "height": height, "next": height,
+                                       "blocks": [], "token": token}, addr)
+                    return
+                for datagram in self.pack_blocks(height, min(count, self.MAX_BATCH_BLOCKS)):
+                    self.send_bytes(datagram, addr)
 
         elif msg_type == "CONSENSUS":
             # Perform consensus triggered by an external request
             print("Performing consensus triggered by external request.")
-            self.perform_consensus()
+            self.start_consensus()
 
         elif msg_type == "GOSSIP":
             self.handle_gossip(message, addr)
 
+        elif msg_type == "GOSSIP_REPLY":
+            self.mark_alive((message["host"], message["port"]))
+
         elif msg_type == "ANNOUNCE":
-            self.handle_announce(message)
+            self.handle_announce(message, addr)
+
+        elif msg_type == "GET_BLOCK_REPLY":
+            # A parent asked for by handle_announce; consensus fetches on its own sockets
+            if message.get("height") is not None:
+                self.handle_announce(message, addr)
+
+        elif msg_type == "METRICS":
+            token = self.address_token(addr)
+            if not hmac.compare_digest(str(message.get("token")), token):
+                # Gated like GET_BLOCKS, so a spoofed source gets nothing bigger than its request
+                self.send_message({"type": "METRICS_REPLY", "token": token}, addr)
+                return
+            self.send_message(self.get_metrics(), addr)
+
+    def encoded_stats_reply(self):
+        """The STATS_REPLY for the current tip, encoded once per tip."""
+        tip = self.blockchain.tip
+        cached_tip, data = self.stats_reply
+        if data is None or cached_tip is not tip:
+            data = json.dumps({
+                "type": "STATS_REPLY",
+                "height": tip.height + 1 if tip is not None else 0,
+                "hash": tip.hash_hex if tip is not None else None,
+            }).encode()
+            self.stats_reply = (tip, data)
+        return data
+
+    def encoded_block_reply(self, height):
+        """
+        The GET_BLOCK_REPLY for the block at `height`, encoded once and reused.
+
+        Blocks never change once they are in the chain; a reorg puts other
+        Block objects in their place. So a cached reply is used only while
+        its block is still the one at that height, and a reorg needs no
+        explicit invalidation.
+        """
+        block = self.blockchain.chain[height]
+        cached = self.block_replies.get(height)
+        if cached is not None and cached[0] is block:
+            return cached[1]
+        data = json.dumps(block.to_wire()).encode()
+        if self.REPLY_CACHE_SIZE:
+            if height not in self.block_replies and len(self.block_replies) >= self.REPLY_CACHE_SIZE:
+                # Oldest entry first; dicts keep insertion order
+                del self.block_replies[next(iter(self.block_replies))]
+            self.block_replies[height] = (block, data)
+        return data
+
+    def address_token(self, addr):
+        """
+        The token a GET_BLOCKS or METRICS from `addr` has to carry to be answered in full.
+
+        It is a MAC of the sender's IP address, so checking it needs no state
+        and it covers every socket a fetcher opens from that host.
+        """
+        return hmac.new(self.token_key, addr[0].encode(), "sha256").hexdigest()[:32]
+
+    def pack_blocks(self, start, count):
+        """
+        Encode blocks start..start+count-1 as GET_BLOCKS_REPLY datagrams of at most MAX_DATAGRAM bytes.
+
+        Each datagram holds consecutive blocks from its "height" on, as the
+        same cached bytes a GET_BLOCK for them is answered with. Its "next"
+        is the height after its last block, or None if our chain ends there.
+        A request past our tip gets one datagram with no blocks.
+        """
+        chain = self.blockchain.chain
+        end = min(start + count, len(chain))
+        datagrams = []
+        height = start
+        while True:
+            encoded = []
+            size = 100  # Envelope around the blocks, generously
+            while height < end:
+                block = self.encoded_block_reply(height)
+                # A block too big to share a datagram still goes out on its own
+                if encoded and size + len(block) + 1 > self.MAX_DATAGRAM:
+                    break
+                encoded.append(block)
+                size += len(block) + 1
+                height += 1
+            first = height - len(encoded)
+            next_height = height if height < len(chain) else None
+            envelope = json.dumps({"type": "GET_BLOCKS_REPLY", "height": first, "next": next_height, "blocks": []})
+            datagrams.append(envelope[:-2].encode() + b",".join(encoded) + b"]}")
+            if height >= end:
+                return datagrams
 
     def send_message(self, message, destination):
         """Send a JSON-encoded message to the given destination."""
+        self.send_bytes(json.dumps(message).encode(), destination)
+
+    def send_bytes(self, data, destination):
+        """Send an encoded datagram, through the event loop's transport once serve() has opened it."""
         try:
-            self.sock.sendto(json.dumps(message).encode(), destination)
+            if self.transport is not None:
+                self.transport.sendto(data, destination)
+            else:
+                self.sock.sendto(data, destination)
         except Exception as e:
             print(f"Error sending message to {destination}: {e}")
 
-    def listen(self):
-        """Listen for incoming UDP messages."""
-        while self.running:
-            try:
-                data, addr = self.sock.recvfrom(4096)
-                message = json.loads(data.decode())
-                self.handle_message(message, addr)
-            except Exception as e:
-                print(f"Error handling message: {e}")
-
-    def start_mining_loop(self):
-        """Continuously mine new blocks without user input."""
+    def handle_datagram(self, data, addr):
+        """Decode one incoming datagram and handle it."""
+        try:
+            message = json.loads(data.decode())
+            self.handle_message(message, addr)
+        except Exception as e:
+            print(f"Error handling message: {e}")
+
+    async def open_endpoint(self):
+        """Start receiving on the peer's socket through the running event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.transport, _ = await self.loop.create_datagram_endpoint(lambda: PeerProtocol(self), sock=self.sock)
+
+    async def serve(self):
+        """Answer messages until stop() is called, without mining, gossip or consensus."""
+        await self.open_endpoint()
+        try:
+            await self.stopped.wait()
+        finally:
+            self.transport.close()
+
+    async def mining_loop(self):
+        """Mining control task: continuously mine new blocks without user input."""
         while self.running:
             # If mining is disabled, wait until it's enabled again
             if not self.mining_enabled:
-                time.sleep(1)
+                await asyncio.sleep(1)
                 continue
 
+            # Build the template from the current tip; any later change sets the event
+            self.tip_changed.clear()
             messages = ["Jihan", "Park", "Mirha"]  # Example messages
             new_block = self.create_new_block(messages, self.name)
-            mined_block = self.mine_block(new_block)
+            # Waiting on the workers' result queue blocks, so it happens off the loop
+            mined_block = await asyncio.to_thread(self.mine_block, new_block)
             if mined_block:
                 self.add_block(mined_block)
+            elif self.tip_changed.is_set():
+                # Rebuild on the new tip straight away
+                continue
             # Add a small delay to prevent rapid-fire mining loops
-            time.sleep(1)
+            await asyncio.sleep(1)
 
-    def start(self):
-        """Start the peer, including the listener thread and consensus process."""
-        threading.Thread(target=self.listen, daemon=True).start()
+    async def run(self):
+        """Serve messages while consensus, gossip, metrics and mining run as tasks beside them."""
+        await self.open_endpoint()
         print(f"Peer started on {self.host}:{self.port}")
+        tasks = [asyncio.create_task(self.periodic_gossip()), asyncio.create_task(self.periodic_metrics())]
+        if self.chain_store is not None:
+            tasks.append(asyncio.create_task(self.periodic_store_flush()))
+        try:
+            # Mining waits for the initial consensus; messages are answered throughout
+            print("Performing initial consensus...")
+            await self.start_consensus()
+            print("Initial consensus complete.")
+            tasks.append(asyncio.create_task(self.mining_loop()))
+            await self.stopped.wait()
+        finally:
+            # Also reached when Ctrl-C cancels run(). asyncio.run then waits for
+            # the mine_block thread, which only returns once running is False.
+            self.running = False
+            self.mining_pool.stop()
+            self.stopped.set()
+            for task in tasks:
+                task.cancel()
+            self.transport.close()
 
-        threading.Thread(target=self.periodic_gossip, daemon=True).start()
-
-        # Perform initial consensus
-        print("Performing initial consensus...")
-        self.perform_consensus()
-        print("Initial consensus complete.")
-
-        # Start mining automatically in a separate thread
-        # so that the main thread can handle other tasks.
-        threading.Thread(target=self.start_mining_loop, daemon=True).start()
-
-        # Keep the main thread alive
+    def start(self):
+        """Start the peer and run its event loop until it is stopped."""
+        # Fork the mining workers before any threads exist
+        self.mining_pool.start()
         try:
-            while self.running:
-                time.sleep(1)
+            asyncio.run(self.run())
         except KeyboardInterrupt:
             self.stop()
+        finally:
+            # asyncio.run has waited for the loop's threads, so nothing writes to the store now
+            if self.chain_store is not None:
+                self.chain_store.close()
 
     def stop(self):
-        """Stop the peer gracefully."""
+        """Stop the peer gracefully. Safe to call from any thread."""
         self.running = False
-        self.sock.close()
+        self.mining_pool.stop()
+        if self.loop is not None and not self.loop.is_closed():
+            # serve() or run() closes the socket on its way out, and start() the store
+            self.loop.call_soon_threadsafe(self.stopped.set)
+        else:
+            self.sock.close()
+            if self.chain_store is not None:
+                self.chain_store.close()
         print("Peer stopped.")
 
 
@@ -415,7 +783,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Blockchain Peer")
     parser.add_argument("--host", required=True, help="Host for the peer")
     parser.add_argument("--port", type=int, required=True, help="Port for the peer")
+    parser.add_argument("--node-index", type=int, default=0,
+                        help="Index of this machine among those mining under the same name")
+    parser.add_argument("--store", default=None,
+                        help="SQLite file the chain is kept in across restarts (default: sardukar_<port>.db)")
+    parser.add_argument("--no-store", action="store_true", help="Keep the chain in memory only")
     args = parser.parse_args()
 
-    peer = Peer(args.host, args.port)
+    store_path = None if args.no_store else args.store or f"sardukar_{args.port}.db"
+    peer = Peer(args.host, args.port, args.node_index, store_path)
     peer.start()
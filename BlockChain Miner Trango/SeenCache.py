@@ -0,0 +1,68 @@
+import time
+from collections import deque
+
+
+class SeenCache:
+    """
+    Set of recently seen message IDs with a time limit and a size ceiling.
+
+    IDs are kept in time buckets, BUCKET_SECONDS wide. A whole bucket is
+    dropped once it is older than `ttl`, or early if the cache holds more
+    than `max_ids`, so expiry costs nothing per ID. A bucket is also closed
+    once it holds a tenth of `max_ids`, so even a flood of gossip inside
+    one bucket's time cannot push memory past the ceiling.
+    """
+    BUCKET_SECONDS = 30
+    BUCKETS_PER_CEILING = 10
+
+    def __init__(self, ttl=300, max_ids=10000):
+        self.ttl = ttl
+        self.max_ids = max_ids
+        self.buckets = deque()  # (bucket start time, set of IDs), oldest first
+        self.size = 0
+        self.duplicates = 0  # add() calls for an ID already held
+        self.expired = 0  # IDs dropped for age
+        self.evicted = 0  # IDs dropped early to stay under max_ids
+
+    def _drop_oldest(self):
+        _, ids = self.buckets.popleft()
+        self.size -= len(ids)
+        return len(ids)
+
+    def add(self, message_id, now=None):
+        """
+        Remember `message_id`.
+
+        Returns:
+            True if it was not already held, False for a duplicate.
+        """
+        now = time.time() if now is None else now
+        while self.buckets and self.buckets[0][0] <= now - self.ttl:
+            self.expired += self._drop_oldest()
+        if message_id in self:
+            self.duplicates += 1
+            return False
+        if (not self.buckets or self.buckets[-1][0] <= now - self.BUCKET_SECONDS
+                or len(self.buckets[-1][1]) >= max(1, self.max_ids // self.BUCKETS_PER_CEILING)):
+            self.buckets.append((now, set()))
+        self.buckets[-1][1].add(message_id)
+        self.size += 1
+        # Never drops the bucket just added to
+        while self.size > self.max_ids and len(self.buckets) > 1:
+            self.evicted += self._drop_oldest()
+        return True
+
+    def __contains__(self, message_id):
+        return any(message_id in ids for _, ids in self.buckets)
+
+    def __len__(self):
+        return self.size
+
+    def summary(self):
+        """Counters for METRICS."""
+        return {
+            "size": self.size,
+            "duplicates": self.duplicates,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
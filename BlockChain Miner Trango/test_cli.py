@@ -11,11 +11,15 @@ statsMessage = {
     "type": "STATS"
 }
 
+# A peer sends at most 64 blocks for one GET_BLOCKS
+BLOCKS_PER_REQUEST = 64
+
 
 class TestShell(cmd.Cmd):
     intro = 'Welcome to the 3010 verifier shell version 2.   Type help or ? to list commands.\n'
     prompt = '3010 > '
     coordinatorSock = None
+    peerToken = None  # The peer's token for our address (GET_BLOCKS, METRICS), once it has sent one
 
     def preloop(self) -> None:
         '''
@@ -167,6 +171,98 @@ class TestShell(cmd.Cmd):
                 print(type(e))
                 print(e)
 
+    def do_blocks(self, arg):
+        '''
+        get a run of links from the chain. Usage blocks start count
+        Asks for BLOCKS_PER_REQUEST links at a time, since a peer caps each request
+        Falls back to one get per link if the peer does not know GET_BLOCKS
+        '''
+        try:
+            start, count = [int(x) for x in arg.split()]
+        except ValueError:
+            print("Usage: blocks start count")
+            return
+
+        received = {}
+        height = start
+        chain_ended = False
+        try:
+            while height < start + count and not chain_ended:
+                asked = min(BLOCKS_PER_REQUEST, start + count - height)
+                content = {
+                    "type": "GET_BLOCKS",
+                    "height": height,
+                    "count": asked,
+                    "token": self.peerToken
+                }
+                self.sock.sendto(json.dumps(content).encode(),
+                                 (self.hostname, self.port))
+                # The reply may span several datagrams; "next" is null once the chain ends
+                while not all(h in received for h in range(height, height + asked)):
+                    reply = json.loads(self.sock.recv(4096))
+                    if reply.get("type") != "GET_BLOCKS_REPLY":
+                        continue
+                    if "token" in reply and not reply["blocks"]:
+                        # The peer only sends blocks once we echo its token back
+                        if content["token"] == reply["token"]:
+                            print("Peer keeps refusing our token")
+                            return
+                        self.peerToken = content["token"] = reply["token"]
+                        self.sock.sendto(json.dumps(content).encode(),
+                                         (self.hostname, self.port))
+                        continue
+                    for block in reply["blocks"]:
+                        received[block["height"]] = block
+                    if reply["next"] is None:
+                        chain_ended = True
+                        break
+                # The next request picks up at this one's last "next"
+                height += asked
+        except socket.timeout:
+            if not received:
+                print("Timed out! Peer does not support GET_BLOCKS? Getting one at a time")
+                for h in range(start, start + count):
+                    self.do_get(str(h))
+                return
+            print("Timed out; some blocks are missing")
+        except json.JSONDecodeError:
+            print("Got bad json in return")
+        except Exception as e:
+            print("Error sending/receiving")
+            print(e)
+
+        for h in sorted(received):
+            pp.pprint(received[h])
+        print("Got {} of {} blocks".format(len(received), count))
+
+    def do_metrics(self, arg):
+        '''
+        Gets mining metrics from this peer
+        '''
+        try:
+            content = {"type": "METRICS", "token": self.peerToken}
+            self.sock.sendto(json.dumps(content).encode(), (self.hostname, self.port))
+            response = self.sock.recv(4096)
+            metrics = json.loads(response)
+            if "token" in metrics:
+                # The peer only sends metrics once we echo its token back
+                self.peerToken = content["token"] = metrics["token"]
+                self.sock.sendto(json.dumps(content).encode(), (self.hostname, self.port))
+                response = self.sock.recv(4096)
+                metrics = json.loads(response)
+                if "token" in metrics:
+                    print("Peer keeps refusing our token")
+                    return
+            pp.pprint(metrics)
+        except socket.timeout:
+            print("Timed out! Peer does not support METRICS?")
+        except json.JSONDecodeError:
+            print("Got bad json in return")
+            print(response)
+        except Exception as e:
+            print("Error sending/receiving")
+            print(e)
+
     def do_exit(self, arg):
         print('Later, gator.')
         return True